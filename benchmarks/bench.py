@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks for the iCalendar rendering and Mailer hot paths.
+
+Run from the repository root::
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --compare results.json
+
+With ``--compare``, the exit status is 1 when any benchmark got slower than
+the baseline by more than ``--threshold``.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import socket
+import platform
+import argparse
+import datetime
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime as DateTime
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from fortnight import Mailer, iCalendar                      # NOQA
+from fortnight.render import render_pool                      # NOQA
+from fortnight.transport import MemoryTransport, SMTPTransport  # NOQA
+
+START = DateTime(2014, 12, 1, 7, 30)
+
+ICAL_CONFIG = {
+    'method': 'REQUEST',
+    'organizer_email': 'organizer@example.com',
+    'attendee_email': 'attendee@example.com',
+    'description': 'This is an iCalendar Event Description',
+    'dtstart': START,
+    'dtend': START + datetime.timedelta(hours=1),
+    'dtstamp': START,
+    'location': 'The Moon',
+    'status': 'TENTATIVE',
+    'summary': 'This is an iCalendar Event Summary',
+}
+
+MAIL_CONFIG = {
+    'email_to': 'attendee@example.com',
+    'email_from': 'organizer@example.com',
+    'email_subject': 'This is the subject of the email',
+    'email_body': 'This is the body of the email',
+}
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """ Accepts every message and throws it away """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        socketserver.StreamRequestHandler.setup(self)
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply('220 localhost stub')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].decode('ascii').upper()
+            if command == 'EHLO':
+                self.reply('250-localhost\r\n250 SIZE 0')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                for data in iter(self.rfile.readline, b''):
+                    if data == b'.\r\n':
+                        break
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class StubSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        StubSMTPHandler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+def make_mailer(transport=None):
+    mail = Mailer(dict(MAIL_CONFIG))
+    mail.attach(iCalendar(dict(ICAL_CONFIG)))
+    if transport is not None:
+        mail.transport = transport
+    return mail
+
+
+def bench_from_dict():
+    return lambda: iCalendar(ICAL_CONFIG)
+
+
+def bench_dtstart_roundtrip():
+    cal = iCalendar(ICAL_CONFIG)
+
+    def run():
+        cal.dtstart = START
+        return cal.dtstart
+    return run
+
+
+def bench_to_string():
+    cal = iCalendar(ICAL_CONFIG)
+
+    def run():
+        # Drop the cached lines so that every call is a full render
+        cal._lines = None
+        return cal.to_string()
+    return run
+
+
+def bench_reschedule():
+    cal = iCalendar(ICAL_CONFIG)
+    cal.to_string()
+    later = datetime.timedelta(minutes=30)
+
+    def run():
+        cal.dtstart += later
+        cal.dtend += later
+        return cal.to_string()
+    return run
+
+
+def bench_mime_build():
+    transport = MemoryTransport()
+    mail = make_mailer(transport)
+
+    def run():
+        mail.send_email()
+        del transport.messages[:]
+    return run
+
+
+def bench_render_pool(processes, count):
+    records = [ICAL_CONFIG] * count
+
+    def run():
+        for rendered in render_pool(records, MAIL_CONFIG, processes):
+            pass
+    return run
+
+
+def bench_smtp_send(server):
+    host, port = server.server_address
+    mail = make_mailer(SMTPTransport(host, port))
+    return mail.send_email
+
+
+def bench_bulk_send(server, count):
+    host, port = server.server_address
+
+    def run():
+        transport = SMTPTransport(host, port)
+        mail = make_mailer(transport)
+        with transport:
+            for i in range(count):
+                mail.send_email()
+    return run
+
+
+def bench_import(modules):
+    """ Start a fresh interpreter importing ``modules``, so the time
+    includes the package's import cost and nothing cached from this process
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    statement = '; '.join('import %s' % name for name in modules) or 'pass'
+    argv = [sys.executable, '-c', statement]
+
+    def run():
+        subprocess.check_call(argv, cwd=root)
+    return run
+
+
+def measure(name, func, number, repeat, ops=1):
+    """ Time ``func`` and return a result dict; times are per operation,
+    where one call of ``func`` performs ``ops`` operations.
+    """
+    func()  # warm up
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    per_op = sorted(t / (number * ops) for t in times)
+    result = {
+        'name': name,
+        'number': number,
+        'repeat': repeat,
+        'ops': ops,
+        'best': per_op[0],
+        'median': per_op[len(per_op) // 2],
+        'ops_per_sec': 1.0 / per_op[0] if per_op[0] else None,
+    }
+    sys.stderr.write('%-24s %12.2f us/op %12.0f ops/s\n'
+                     % (name, result['best'] * 1e6, result['ops_per_sec']))
+    return result
+
+
+def run_all(scale, repeat, sizes):
+    results = []
+    results.append(measure('import_python', bench_import([]),
+                           10 * scale, repeat))
+    results.append(measure('import_fortnight', bench_import(['fortnight']),
+                           10 * scale, repeat))
+    results.append(measure('import_fortnight_mail',
+                           bench_import(['fortnight.mail']),
+                           10 * scale, repeat))
+    results.append(measure('ical_from_dict', bench_from_dict(),
+                           5000 * scale, repeat))
+    results.append(measure('ical_dtstart_roundtrip',
+                           bench_dtstart_roundtrip(), 5000 * scale, repeat))
+    results.append(measure('ical_to_string', bench_to_string(),
+                           5000 * scale, repeat))
+    results.append(measure('ical_reschedule', bench_reschedule(),
+                           5000 * scale, repeat))
+    results.append(measure('mailer_mime_build', bench_mime_build(),
+                           500 * scale, repeat))
+    cpus = multiprocessing.cpu_count()
+    for processes in sorted(set([1, cpus])):
+        results.append(measure('render_pool_%d' % processes,
+                               bench_render_pool(processes, 2000 * scale),
+                               1, repeat, ops=2000 * scale))
+    with StubSMTPServer() as server:
+        results.append(measure('mailer_smtp_send', bench_smtp_send(server),
+                               50 * scale, repeat))
+        for size in sizes:
+            results.append(measure('mailer_bulk_send_%d' % size,
+                                   bench_bulk_send(server, size),
+                                   1, repeat, ops=size))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Report benchmarks whose best time regressed beyond ``threshold``
+
+    :return: List of regressed benchmark names
+    """
+    previous = dict((r['name'], r) for r in baseline['results'])
+    regressed = []
+    for result in results:
+        old = previous.get(result['name'])
+        if not old:
+            continue
+        change = (result['best'] - old['best']) / old['best']
+        flag = ''
+        if change > threshold:
+            regressed.append(result['name'])
+            flag = '  REGRESSION'
+        sys.stderr.write('%-24s %+7.1f%%%s\n'
+                         % (result['name'], change * 100, flag))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Baseline JSON results to compare')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Allowed slowdown before flagging a regression '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=int, default=1,
+                        help='Multiplier for iteration counts')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 100, 10000],
+                        help='Message counts for the bulk send benchmarks')
+    args = parser.parse_args(argv)
+
+    results = run_all(args.scale, args.repeat, args.sizes)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Renders a batch of invites with timing hooks enabled and serves the
+collected histograms for Prometheus to scrape at http://localhost:9100/
+"""
+
+import datetime
+from datetime import datetime as DateTime
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from fortnight import Mailer, iCalendar
+from fortnight.instrument import HistogramObserver
+from fortnight.transport import MemoryTransport
+
+observer = HistogramObserver()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = observer.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def send_invites(count):
+    start = DateTime(2014, 12, 1, 7, 30)
+    mail = Mailer({
+        'email_to': 'attendee@example.com',
+        'email_from': 'organizer@example.com',
+        'email_subject': 'This is the subject of the email',
+        'email_body': 'This is the body of the email',
+    })
+    mail.observer = observer
+    # Swap in SMTPTransport('vm.local', 25, observer=observer) to time the
+    # SMTP conversation as well.
+    mail.transport = MemoryTransport()
+
+    for i in range(count):
+        cal = iCalendar({
+            'method': 'REQUEST',
+            'organizer_email': 'organizer@example.com',
+            'attendee_email': 'attendee@example.com',
+            'dtstart': start + datetime.timedelta(days=i),
+            'dtend': start + datetime.timedelta(days=i, hours=1),
+            'dtstamp': DateTime.utcnow(),
+            'status': 'CONFIRMED',
+            'summary': 'Meeting %d' % i,
+        })
+        mail.attach(cal)
+        mail.send_email()
+
+
+def main():
+    send_invites(1000)
+    HTTPServer(('', 9100), MetricsHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from icalendar import iCalendar  # NOQA
-from mail import Mailer          # NOQA
+import sys
+
+from fortnight.icalendar import iCalendar  # NOQA
+
+__all__ = ['iCalendar', 'Mailer']
+
+if sys.version_info >= (3, 7):
+    # Mailer pulls in smtplib and the email package, which processes that
+    # only render events never need; load it on first access.
+    def __getattr__(name):
+        if name == 'Mailer':
+            from fortnight.mail import Mailer
+            globals()['Mailer'] = Mailer
+            return Mailer
+        raise AttributeError('module %r has no attribute %r'
+                             % (__name__, name))
+else:
+    from fortnight.mail import Mailer  # NOQA
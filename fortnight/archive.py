@@ -0,0 +1,575 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A compact archive of sent invites.
+
+Assign an :py:class:`ArchiveWriter` to :py:attr:`fortnight.Mailer.archive`
+and every message the mailer sends is recorded once the transport has
+accepted it, along with the recipients it was delivered to.  Messages
+skipped by the ledger or that fail to send are not recorded.  Rather than
+the MIME text, which carries the iCalendar body twice, the archive keeps
+the field values the message was built from, so
+:py:meth:`ArchiveReader.message` can rebuild the exact message.
+
+The file is a sequence of segments, each holding up to ``segment_size``
+records.  A segment stores every distinct value once in a string table,
+then one column per field, listing the string table index of each record's
+value.  The string table and each column are compressed separately.
+Each segment also carries its own index: its UIDs in sorted order with
+their rows, the date of each record's DTSTART, and in its header the
+range of those dates.  :py:class:`ArchiveReader` reads only segment
+headers when it opens an archive, and looks up UIDs and dates in these
+small blocks, without decompressing string tables or columns.
+
+Each segment ends with a trailer holding its length and CRC32, so that a
+segment torn by a crash while it was written is recognized.  The writer
+cuts a torn segment off the end of the file before appending to it, and
+the reader skips damaged stretches, reading every intact segment.
+"""
+
+import re
+import sys
+import zlib
+import struct
+import threading
+from array import array
+from timeit import default_timer
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from fortnight.utils import text_type
+
+MAGIC = b'FNA2'
+END = b'FNAE'
+
+# Magic, record count, block count, first and last DTSTART date
+_HEADER = struct.Struct('>4sII8s8s')
+_LENGTH = struct.Struct('>I')
+_TRAILER = struct.Struct('>II4s')
+_CHUNK = 1 << 16
+_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+_BOUNDARY = re.compile(r'boundary="([^"]+)"')
+
+# Block order within a segment; columns follow from _COLUMNS on
+_NAMES, _LENGTHS, _STRINGS, _UIDS, _UID_ROWS, _DATES, _COLUMNS = range(7)
+# Date of records without a DTSTART, and the range of a segment with none
+_NO_DATE = b' ' * 8
+_NO_RANGE = (b'99999999', b'00000000')
+
+
+def _pack(values):
+    values = array(_TYPECODE, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    try:
+        return values.tobytes()
+    except AttributeError:
+        return values.tostring()
+
+
+def _unpack(data):
+    values = array(_TYPECODE)
+    try:
+        values.frombytes(data)
+    except AttributeError:
+        values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _parse_segment(fileobj, offset, size, verify=False):
+    """ Locate the blocks of the segment at ``offset``
+
+    :param verify: Also check the CRC32 of the segment, for segments found
+    by searching for :py:data:`MAGIC` after a damaged stretch
+    :return: ``(count, blocks, dates, end)``, where ``dates`` is the
+    range of DTSTART dates in the segment, or None if the segment is
+    damaged
+    """
+    fileobj.seek(offset)
+    header = fileobj.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    magic, count, nblocks, first, last = _HEADER.unpack(header)
+    if magic != MAGIC or nblocks < _COLUMNS:
+        return None
+    blocks = []
+    for _ in range(nblocks):
+        length = fileobj.read(_LENGTH.size)
+        if len(length) < _LENGTH.size:
+            return None
+        length, = _LENGTH.unpack(length)
+        start = fileobj.tell()
+        if start + length + _TRAILER.size > size:
+            return None
+        blocks.append((start, length))
+        fileobj.seek(length, 1)
+    end = fileobj.tell()
+    trailer = fileobj.read(_TRAILER.size)
+    if len(trailer) < _TRAILER.size:
+        return None
+    length, crc, end_magic = _TRAILER.unpack(trailer)
+    if end_magic != END or length != end - offset:
+        return None
+    if verify:
+        fileobj.seek(offset)
+        if zlib.crc32(fileobj.read(length)) & 0xffffffff != crc:
+            return None
+    return count, blocks, (first, last), end + _TRAILER.size
+
+
+def _find_magic(fileobj, offset, size):
+    """ Offset of the next :py:data:`MAGIC` from ``offset``, or ``size`` """
+    while offset < size:
+        fileobj.seek(offset)
+        chunk = fileobj.read(_CHUNK + len(MAGIC) - 1)
+        found = chunk.find(MAGIC)
+        if found >= 0:
+            return offset + found
+        offset += _CHUNK
+    return size
+
+
+def _scan_segments(fileobj, path):
+    """ Locate the intact segments of an archive
+
+    :return: ``(segments, damaged, size)``, where ``segments`` lists
+    ``(count, blocks, dates)`` and ``damaged`` the ``(start, end)`` byte
+    ranges skipped
+    :raise ValueError: If the file is not an archive
+    """
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    if size and fileobj.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s: not a fortnight archive' % path)
+    segments = []
+    damaged = []
+    offset = 0
+    verify = False
+    while offset < size:
+        parsed = _parse_segment(fileobj, offset, size, verify)
+        if parsed is not None:
+            count, blocks, dates, offset = parsed
+            segments.append((count, blocks, dates))
+            verify = False
+            continue
+        start = offset
+        offset = _find_magic(fileobj, offset + 1, size)
+        if damaged and damaged[-1][1] == start:
+            start = damaged.pop()[0]
+        damaged.append((start, offset))
+        verify = True
+    return segments, damaged, size
+
+
+def _text(value):
+    if isinstance(value, bytes) and not isinstance(value, text_type):
+        return value.decode('utf-8')
+    return text_type(value)
+
+
+def _addresses(values):
+    # Addresses never contain line breaks, unlike commas, which may appear
+    # in quoted display names
+    return u'\n'.join(_text(value) for value in values)
+
+
+def snapshot(icalendar, email_subject, email_body):
+    """ The values a message is rendered from, taken when it is rendered
+    so that the event may change before the message is sent.  It is
+    carried by :py:class:`fortnight.mail.RenderedMessage` and passed to
+    :py:meth:`ArchiveWriter.add` once the message is sent.
+    """
+    return (dict(icalendar._calendar, **icalendar._params),
+            icalendar._calstr, email_subject, email_body)
+
+
+class ArchiveWriter(object):
+    """ Appends sent invites to an archive file.  Safe to share between
+    threads.
+
+    If the file ends with a segment torn by a crash, it is cut off before
+    anything is appended.
+
+    Records are buffered and written a segment at a time: once
+    ``segment_size`` records are buffered, when a record is added more
+    than ``flush_interval`` seconds after the oldest buffered one, on
+    :py:meth:`flush` and on :py:meth:`close`.
+    :py:meth:`fortnight.Mailer.deliver` flushes the archive when it
+    finishes, so at most the records of a delivery in progress are lost
+    if the process dies.
+
+    :param path: Path of the archive, created if missing and appended to
+    otherwise
+    :param segment_size: Maximum number of records per segment
+    :param compresslevel: zlib compression level
+    :param flush_interval: Maximum age in seconds of a buffered record
+    before the next one added writes the segment out, or None to write
+    only full segments
+    :raise ValueError: If the file exists and is not an archive
+    """
+
+    def __init__(self, path, segment_size=4096, compresslevel=9,
+                 flush_interval=5.0):
+        if segment_size < 1:
+            raise ValueError('segment_size must be positive')
+        self.path = path
+        self.segment_size = segment_size
+        self.compresslevel = compresslevel
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._rows = []
+        self._started = None
+        self._file = open(path, 'ab')
+        try:
+            self._recover()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _recover(self):
+        with open(self.path, 'rb+') as fileobj:
+            _, damaged, size = _scan_segments(fileobj, self.path)
+            if damaged and damaged[-1][1] == size:
+                fileobj.truncate(damaged[-1][0])
+
+    def add(self, source, message, email_from, email_to, delivered_to=None):
+        """ Record a sent message
+
+        :param source: The values the message was rendered from, as
+        returned by :py:func:`snapshot`
+        :param message: The rendered message, as returned by the mailer or
+        :py:func:`fortnight.render.render_pool`
+        :param email_to: List of the recipient addresses the message is
+        addressed to
+        :param delivered_to: List of the recipients that accepted it,
+        defaulting to ``email_to``
+        :raise ValueError: If ``message`` is not a message built by
+        :py:class:`fortnight.Mailer`
+        """
+        if not isinstance(message, str):
+            # Bytes from render_pool
+            message = message.decode('ascii')
+        boundaries = _BOUNDARY.findall(message)
+        if len(boundaries) < 2:
+            raise ValueError('message has no MIME boundaries')
+        values, template, email_subject, email_body = source
+        if delivered_to is None:
+            delivered_to = email_to
+        row = dict((key, _text(value)) for key, value in values.items())
+        row.update({
+            u'template': template,
+            u'email_from': _text(email_from),
+            u'email_to': _addresses(email_to),
+            u'delivered_to': _addresses(delivered_to),
+            u'email_subject': _text(email_subject),
+            u'email_body': _text(email_body),
+            u'boundary_mixed': text_type(boundaries[0]),
+            u'boundary_alternative': text_type(boundaries[1]),
+        })
+        now = default_timer()
+        with self._lock:
+            if not self._rows:
+                self._started = now
+            self._rows.append(row)
+            if (len(self._rows) >= self.segment_size or
+                    self.flush_interval is not None and
+                    now - self._started >= self.flush_interval):
+                self._flush()
+
+    def _flush(self):
+        rows = self._rows
+        if not rows:
+            return
+        columns = sorted(set().union(*rows))
+        index = {}
+        strings = []
+        blocks = [None] * _COLUMNS
+        for column in columns:
+            indexes = []
+            for row in rows:
+                value = row.get(column, u'')
+                try:
+                    indexes.append(index[value])
+                except KeyError:
+                    index[value] = len(strings)
+                    indexes.append(len(strings))
+                    strings.append(value.encode('utf-8'))
+            blocks.append(_pack(indexes))
+        blocks[_NAMES] = u'\n'.join(columns).encode('utf-8')
+        blocks[_LENGTHS] = _pack([len(s) for s in strings])
+        blocks[_STRINGS] = b''.join(strings)
+
+        uids = sorted((row.get(u'uid', u''), number)
+                      for number, row in enumerate(rows))
+        blocks[_UIDS] = u'\n'.join(uid for uid, _ in uids).encode('utf-8')
+        blocks[_UID_ROWS] = _pack([number for _, number in uids])
+        dates = [row.get(u'dtstart', u'')[:8].encode('ascii').ljust(8)
+                 for row in rows]
+        blocks[_DATES] = b''.join(dates)
+        dated = [date for date in dates if date != _NO_DATE]
+        first, last = (min(dated), max(dated)) if dated else _NO_RANGE
+
+        out = [_HEADER.pack(MAGIC, len(rows), len(blocks), first, last)]
+        for block in blocks:
+            block = zlib.compress(block, self.compresslevel)
+            out.append(_LENGTH.pack(len(block)))
+            out.append(block)
+        segment = b''.join(out)
+        self._file.write(segment + _TRAILER.pack(
+            len(segment), zlib.crc32(segment) & 0xffffffff, END))
+        self._file.flush()
+        self._rows = []
+
+    def flush(self):
+        """ Write buffered records as a segment, even if it is not full """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _Segment(object):
+    """ Lazily decompressed view of one segment """
+
+    def __init__(self, fileobj, count, blocks, dates=_NO_RANGE):
+        self._file = fileobj
+        self.count = count
+        self._blocks = blocks
+        self.dates = dates
+        self._uids = None
+        self._columns = {}
+        self._strings = None
+        self._offsets = None
+        self._names = None
+
+    def _read(self, block):
+        offset, length = self._blocks[block]
+        self._file.seek(offset)
+        return zlib.decompress(self._file.read(length))
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self._read(_NAMES).decode('utf-8').split(u'\n')
+        return self._names
+
+    def uids(self):
+        """ The UIDs of the segment in sorted order, and their rows """
+        if self._uids is None:
+            uids = self._read(_UIDS).decode('utf-8').split(u'\n')
+            self._uids = (uids, _unpack(self._read(_UID_ROWS)))
+        return self._uids
+
+    def dated(self, first, last):
+        """ ``(date, row)`` of the rows dated from ``first`` to ``last`` """
+        if last < self.dates[0] or first > self.dates[1]:
+            return []
+        dates = self._read(_DATES)
+        rows = []
+        for row in range(self.count):
+            date = dates[row * 8:row * 8 + 8]
+            if first <= date <= last:
+                rows.append((date, row))
+        return rows
+
+    def column(self, name):
+        try:
+            return self._columns[name]
+        except KeyError:
+            pass
+        try:
+            block = _COLUMNS + self.names.index(name)
+        except ValueError:
+            return None
+        column = self._columns[name] = _unpack(self._read(block))
+        return column
+
+    def string(self, index):
+        if self._strings is None:
+            offsets = [0]
+            for length in _unpack(self._read(_LENGTHS)):
+                offsets.append(offsets[-1] + length)
+            self._offsets = offsets
+            self._strings = self._read(_STRINGS)
+        offsets = self._offsets
+        return self._strings[offsets[index]:offsets[index + 1]].decode(
+            'utf-8')
+
+    def value(self, name, row):
+        column = self.column(name)
+        if column is None:
+            return u''
+        return self.string(column[row])
+
+    def row(self, row):
+        return dict((name, self.value(name, row)) for name in self.names)
+
+
+class ArchiveReader(object):
+    """ Reads an archive written by :py:class:`ArchiveWriter`.
+
+    Records are numbered from 0 in the order they were added, and looked
+    up by UID and by the date of DTSTART through the index of each
+    segment.  Opening the archive reads only the segment headers.  Damaged
+    stretches of the file are skipped, and listed in :py:attr:`damaged`
+    as ``(start, end)`` byte ranges.
+
+    :param path: Path of the archive
+    :param cache_size: Number of decompressed segments kept in memory
+    :raise ValueError: If the file is not an archive
+    """
+
+    def __init__(self, path, cache_size=8):
+        self.path = path
+        self.cache_size = cache_size
+        self._file = open(path, 'rb')
+        self._segments = []
+        self._starts = []
+        self._cache = OrderedDict()
+        self._indexes = {}
+        self._scan()
+
+    def _scan(self):
+        self._segments, self.damaged, _ = _scan_segments(self._file,
+                                                         self.path)
+        total = 0
+        for count, _, _ in self._segments:
+            self._starts.append(total)
+            total += count
+        self._count = total
+
+    def _index(self, number):
+        # Views used for the index only, kept apart from the cache of
+        # segments being read so that a lookup does not evict them
+        try:
+            return self._indexes[number]
+        except KeyError:
+            segment = _Segment(self._file, *self._segments[number])
+            self._indexes[number] = segment
+            return segment
+
+    def __len__(self):
+        return self._count
+
+    def _locate(self, record):
+        if not 0 <= record < self._count:
+            raise IndexError('record %s out of range' % record)
+        number = bisect_right(self._starts, record) - 1
+        segment = self._cache.pop(number, None)
+        if segment is None:
+            segment = _Segment(self._file, *self._segments[number])
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[number] = segment
+        return segment, record - self._starts[number]
+
+    def __getitem__(self, record):
+        """ The field values of a record as a dict of unicode strings.
+        ``email_to`` and ``delivered_to`` hold one address per line.
+        """
+        segment, row = self._locate(record)
+        return segment.row(row)
+
+    def find(self, uid):
+        """ Records of the event with ``uid``, one per revision and
+        recipient, oldest first
+
+        :return: List of record numbers
+        """
+        records = []
+        for number, start in enumerate(self._starts):
+            uids, rows = self._index(number).uids()
+            lo = bisect_left(uids, uid)
+            hi = bisect_right(uids, uid, lo)
+            records.extend(start + row for row in rows[lo:hi])
+        return records
+
+    def between(self, start, end=None):
+        """ Records of events starting on a date from ``start`` to ``end``
+        inclusive, in date order.  Dates are those written in DTSTART,
+        local to its TZID when it has one.
+
+        :param start: datetime.date or datetime.datetime
+        :param end: datetime.date or datetime.datetime, defaults to
+        ``start``
+        :return: List of record numbers
+        """
+        end = start if end is None else end
+        first = start.strftime('%Y%m%d').encode('ascii')
+        last = end.strftime('%Y%m%d').encode('ascii')
+        dated = []
+        for number, segment_start in enumerate(self._starts):
+            dated.extend((date, segment_start + row) for date, row in
+                         self._index(number).dated(first, last))
+        dated.sort()
+        return [record for _, record in dated]
+
+    def icalendar(self, record):
+        """ Rebuild the iCalendar event of a record.  It serializes to the
+        same text as when it was archived; datetime attributes written with
+        a TZID cannot be read back as datetimes, as the tzinfo is not kept.
+
+        :return: iCalendar
+        """
+        from fortnight.icalendar import iCalendar
+        values = self[record]
+        ical = iCalendar()
+        for key in ical._calendar:
+            ical._calendar[key] = values.get(key, u'')
+        for key in ical._params:
+            ical._params[key] = values.get(key, u'')
+        ical._calendar[u'sequence'] = int(values[u'sequence'])
+        ical._calstr = values[u'template']
+        return ical
+
+    def message(self, record):
+        """ Rebuild the message of a record exactly as it was rendered
+
+        :return: str
+        """
+        from fortnight.mail import Mailer
+        values = self[record]
+        mailer = Mailer({
+            'email_from': values[u'email_from'],
+            'email_subject': values[u'email_subject'],
+            'email_body': values[u'email_body'],
+        })
+        ical = self.icalendar(record)
+        return mailer._build_mime(
+            ical, ical.to_string(), values[u'email_to'].split(u'\n'),
+            (values[u'boundary_mixed'], values[u'boundary_alternative']))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
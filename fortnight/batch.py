@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Bulk cancellation and update of events that were already sent.
+
+Each function takes stored :py:class:`fortnight.iCalendar` objects, or
+their UIDs along with a ``store`` mapping UIDs to them, and lazily yields
+the events ready to be sent again, for example with
+:py:meth:`fortnight.Mailer.send_many`::
+
+    mailer.send_many(batch.cancel(uids, store=events))
+
+Events are updated in place rather than copied: only the changed lines of
+their cached serialization are re-rendered, SEQUENCE is incremented once
+per derived revision, and the stored objects reflect the last revision
+sent.
+"""
+
+from fortnight.icalendar import iCalendar
+
+
+def derive(events, method, store=None, **changes):
+    """ Yield each event with its METHOD set to ``method``, ``changes``
+    applied and its SEQUENCE incremented, as RFC 5546 requires of a CANCEL
+    or an updated REQUEST.
+
+    :param events: Iterable of iCalendar objects or UIDs
+    :param method: METHOD of the derived events
+    :param store: Mapping of UIDs to iCalendar objects, needed when
+    ``events`` contains UIDs
+    :param changes: Attribute values to set on every event, as accepted by
+    :py:meth:`fortnight.iCalendar.from_dict`
+    :raise KeyError: If a UID is not found in ``store``
+    :raise ValueError: If ``method`` is unknown or ``changes`` has an
+    unknown attribute; no event is modified
+    """
+    # Validate against a scratch event first, so that a bad method or
+    # changes fail before any stored event is half modified
+    scratch = iCalendar()
+    scratch.method = method
+    if changes:
+        scratch.from_dict(changes)
+    for event in events:
+        if not isinstance(event, iCalendar):
+            if store is None:
+                raise TypeError('"%s" is not an iCalendar and no store was '
+                                'given' % event)
+            try:
+                event = store[event]
+            except KeyError:
+                raise KeyError('No stored event with UID "%s"' % event)
+        if changes:
+            event.from_dict(changes)
+        event.method = method
+        event.sequence = event.sequence + 1
+        yield event
+
+
+def cancel(events, store=None):
+    """ Yield CANCEL messages for each event, with STATUS:CANCELLED """
+    return derive(events, u'CANCEL', store, status=u'CANCELLED')
+
+
+def update(events, store=None, **changes):
+    """ Yield updated REQUEST messages for each event, with ``changes``
+    applied
+    """
+    return derive(events, u'REQUEST', store, **changes)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Send iCalendar invites in bulk from CSV or JSON Lines.
+
+Each input row describes one event, using the attribute names of
+:py:class:`fortnight.iCalendar` (``attendee_email``, ``dtstart``,
+``summary``, ...), and is sent to its ``attendee_email``.  Dates may be
+given as ``20141201T073000Z`` or ISO 8601 and are taken as UTC.  ``method``
+defaults to REQUEST, ``status`` to CONFIRMED and ``dtstamp`` to now.  Rows
+without a ``uid`` get one derived from their other values, so running the
+same input again reuses it and ``--ledger`` skips what was already sent;
+give each row a ``uid`` to send updates or cancellations of an event.
+
+Rows are read as a stream and handed to a pool of sender threads, each
+keeping its own connection open, so inputs of any size run in constant
+memory.
+"""
+
+import io
+import os
+import sys
+import csv
+import json
+import hashlib
+import time
+import argparse
+import threading
+from datetime import datetime as DateTime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from fortnight.archive import ArchiveWriter
+from fortnight.icalendar import iCalendar
+from fortnight.ledger import SendLedger
+from fortnight.mail import Mailer
+from fortnight.transport import LMTPTransport, MaildirTransport, SMTPTransport
+from fortnight.utils import DT_LOCAL_STRF, text_type
+
+DATETIME_FORMATS = (
+    DT_LOCAL_STRF,
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d %H:%M',
+)
+DATETIME_ATTRS = ('dtstart', 'dtend', 'dtstamp')
+# Left out of derived UIDs, as they change between revisions of an event
+REVISION_ATTRS = frozenset(['method', 'status', 'sequence', 'dtstamp',
+                            'partstat'])
+# Read rather than an option, so the password is not shown by ps
+PASSWORD_ENV = 'FORTNIGHT_SMTP_PASSWORD'
+FORMATS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+}
+
+
+def parse_datetime(value):
+    """ Parse a date and time in one of :py:data:`DATETIME_FORMATS`,
+    optionally followed by ``Z``
+
+    :raise ValueError: If ``value`` is in none of them
+    """
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    for fmt in DATETIME_FORMATS:
+        try:
+            return DateTime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('"%s" is not a recognized date and time' % value)
+
+
+def row_uid(row):
+    """ A UID derived from the values of a row, other than those in
+    :py:data:`REVISION_ATTRS`
+    """
+    values = dict((text_type(k), text_type(v)) for k, v in row.items()
+                  if k not in REVISION_ATTRS and v is not None and v != '')
+    canonical = json.dumps(values, sort_keys=True).encode('utf-8')
+    return text_type(hashlib.sha1(canonical).hexdigest())
+
+
+def event_from_row(row):
+    """ Build an iCalendar from one input row
+
+    :raise ValueError: If a value is invalid
+    :raise TypeError: If a value is of the wrong type
+    """
+    if not isinstance(row, dict):
+        raise ValueError('row is not an object')
+    config = {
+        'uid': row_uid(row),
+        'method': u'REQUEST',
+        'status': u'CONFIRMED',
+        'dtstamp': DateTime.utcnow().replace(microsecond=0),
+    }
+    for key, value in row.items():
+        if value is None or value == '':
+            continue
+        if key in DATETIME_ATTRS:
+            value = parse_datetime(value)
+        elif key == 'sequence':
+            value = int(value)
+        config[key] = value
+    return iCalendar(config)
+
+
+def _decode(value):
+    if isinstance(value, bytes) and not isinstance(value, text_type):
+        return value.decode('utf-8')
+    return value
+
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield dict((_decode(k), _decode(v)) for k, v in row.items())
+
+
+def read_jsonl(stream):
+    """ Yield the non-blank lines of a JSON Lines stream.  They are parsed
+    with :py:func:`parse_jsonl` by :py:func:`run`, so that a malformed line
+    fails on its own.
+    """
+    for line in stream:
+        line = _decode(line).strip()
+        if line:
+            yield line
+
+
+def parse_jsonl(line):
+    return json.loads(line)
+
+
+def open_input(path):
+    if path == '-':
+        return sys.stdin
+    if bytes is str:
+        return open(path, 'rb')
+    return io.open(path, encoding='utf-8', newline='')
+
+
+class Stats(object):
+    def __init__(self):
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, sent=0, skipped=0, failed=0):
+        with self._lock:
+            self.sent += sent
+            self.skipped += skipped
+            self.failed += failed
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        rate = self.sent / elapsed if elapsed else 0.0
+        return ('sent=%d skipped=%d failed=%d elapsed=%.2fs rate=%.1f/s'
+                % (self.sent, self.skipped, self.failed, elapsed, rate))
+
+
+class _Senders(object):
+    """ Number of sender threads still delivering """
+
+    def __init__(self, count):
+        self.live = count
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """ Record that a sender stopped
+
+        :return: True if no sender is left
+        """
+        with self._lock:
+            self.live -= 1
+            return self.live == 0
+
+
+def _log(message):
+    sys.stderr.write('fortnight: %s\n' % message)
+
+
+def make_transport(args):
+    if args.maildir:
+        return MaildirTransport(args.maildir)
+    if args.lmtp:
+        host, _, port = args.lmtp.rpartition(':')
+        if host and port.isdigit() and not args.lmtp.startswith('/'):
+            return LMTPTransport(host, int(port))
+        return LMTPTransport(args.lmtp)
+    return SMTPTransport(args.smtp_host, args.smtp_port,
+                         username=args.username, password=args.password)
+
+
+def _sender(args, config, ledger, archive, events, stats, senders):
+    mailer = Mailer(config)
+    mailer.transport = make_transport(args)
+    if ledger is not None:
+        mailer.ledger = ledger
+    if archive is not None:
+        mailer.archive = archive
+    counts = {'rendered': 0, 'sent': 0, 'failed': 0}
+
+    def rendered():
+        for event in iter(events.get, None):
+            try:
+                item = mailer.render(event)
+            except Exception as e:
+                _log('UID %s: %s' % (event.uid, e))
+                stats.add(failed=1)
+                continue
+            counts['rendered'] += 1
+            yield item
+
+    def on_sent(item):
+        counts['sent'] += 1
+
+    def on_error(item, e):
+        _log('UID %s to %s: %s' % (item.key[0], ','.join(item.email_to), e))
+        counts['failed'] += 1
+        stats.add(failed=1)
+
+    try:
+        mailer.deliver(rendered(), on_error=on_error, on_sent=on_sent)
+    except Exception as e:
+        # The transport itself failed.  Leave the queue to the senders
+        # still running; the last one to stop drains it so that the reader
+        # is never blocked, counting everything left as failed.
+        _log('sender stopped: %s' % e)
+        if senders.stop():
+            stats.add(failed=sum(1 for _ in iter(events.get, None)))
+    finally:
+        stats.add(sent=counts['sent'],
+                  skipped=counts['rendered'] - counts['sent'] -
+                  counts['failed'])
+
+
+def run(args, rows, stats, parse=None):
+    """ Send an event for each row, counting the outcomes in ``stats``
+
+    :param rows: Iterable of rows, dicts or raw records for ``parse``
+    :param parse: Optional callable turning each item of ``rows`` into a
+    dict; rows it rejects with ValueError are counted as failed
+    """
+    config = {
+        'email_from': args.email_from,
+        'email_subject': args.subject,
+        'email_body': args.body,
+    }
+    ledger = SendLedger(args.ledger) if args.ledger else None
+    archive = ArchiveWriter(args.archive) if args.archive else None
+    events = queue.Queue(maxsize=args.workers * 64)
+    senders = _Senders(args.workers)
+    threads = [threading.Thread(target=_sender,
+                                args=(args, config, ledger, archive, events,
+                                      stats, senders))
+               for _ in range(args.workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for number, row in enumerate(rows, 1):
+            try:
+                if parse is not None:
+                    row = parse(row)
+                event = event_from_row(row)
+            except (ValueError, TypeError, AttributeError) as e:
+                _log('row %d: %s' % (number, e))
+                stats.add(failed=1)
+                continue
+            events.put(event)
+    finally:
+        # Even if reading the input failed, let the senders finish what
+        # is queued and write out the ledger and archive
+        for thread in threads:
+            events.put(None)
+        for thread in threads:
+            thread.join()
+        if ledger is not None:
+            ledger.close()
+        if archive is not None:
+            archive.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='fortnight', description=__doc__.splitlines()[0])
+    parser.add_argument('input', nargs='?', default='-',
+                        help='CSV or JSON Lines file; "-" reads stdin '
+                             '(default)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='Input format; guessed from the file extension '
+                             'and otherwise jsonl')
+    parser.add_argument('--from', dest='email_from', required=True,
+                        help='Sender address')
+    parser.add_argument('--subject', required=True, help='Email subject')
+    body = parser.add_mutually_exclusive_group(required=True)
+    body.add_argument('--body', help='Email body')
+    body.add_argument('--body-file', type=argparse.FileType('r'),
+                      help='Read the email body from this file')
+
+    delivery = parser.add_argument_group('delivery')
+    delivery.add_argument('--smtp-host', default='localhost')
+    delivery.add_argument('--smtp-port', type=int, default=25)
+    delivery.add_argument('--username', help='SMTP login user name')
+    delivery.add_argument('--password-file', type=argparse.FileType('r'),
+                          help='Read the SMTP login password from the first '
+                               'line of this file; otherwise it is taken '
+                               'from $%s' % PASSWORD_ENV)
+    delivery.add_argument('--lmtp', metavar='HOST[:PORT]|SOCKET',
+                          help='Deliver over LMTP instead of SMTP')
+    delivery.add_argument('--maildir', metavar='PATH',
+                          help='Write messages to a maildir instead')
+    delivery.add_argument('--workers', type=int, default=4,
+                          help='Concurrent connections (default: '
+                               '%(default)s)')
+    delivery.add_argument('--ledger', metavar='PATH',
+                          help='SQLite send ledger; recipients already sent '
+                               'an event revision are skipped')
+    delivery.add_argument('--archive', metavar='PATH',
+                          help='Append every invite sent to this archive')
+
+    args = parser.parse_args(argv)
+    if args.body_file:
+        args.body = args.body_file.read()
+    if args.password_file:
+        with args.password_file:
+            args.password = args.password_file.readline().rstrip('\r\n')
+    else:
+        args.password = os.environ.get(PASSWORD_ENV)
+    if args.username and not args.password:
+        parser.error('--username needs a password, from --password-file or '
+                     '$%s' % PASSWORD_ENV)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if not args.format:
+        ext = os.path.splitext(args.input)[1].lower()
+        args.format = FORMATS.get(ext, 'jsonl')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.format == 'csv':
+        read, parse = read_csv, None
+    else:
+        read, parse = read_jsonl, parse_jsonl
+    stats = Stats()
+    status = 0
+    stream = open_input(args.input)
+    try:
+        run(args, read(stream), stats, parse)
+    except (csv.Error, EnvironmentError, UnicodeDecodeError) as e:
+        _log('reading %s: %s' % (args.input, e))
+        status = 1
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    _log(stats.summary())
+    return 1 if stats.failed else status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,3 +17,11 @@ STATUS = (
     'CONFIRMED',
     'TENTATIVE'
 )
+
+PARTSTAT = (
+    'NEEDS-ACTION',
+    'ACCEPTED',
+    'DECLINED',
+    'TENTATIVE',
+    'DELEGATED'
+)
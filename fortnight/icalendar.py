@@ -15,12 +15,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import uuid
 import datetime
-import defaults
+from string import Formatter
 from datetime import datetime as DateTime
 
-from fortnight.utils import DT_STRF, strip_angle_brackets
+from fortnight import defaults, timezone
+from fortnight.utils import (DT_STRF, DT_LOCAL_STRF, integer_types,
+                             strip_angle_brackets, text_type)
+
+# Changes to these fields alone do not make a new revision of the event, so
+# they do not increment SEQUENCE (RFC 5545, section 3.8.7.4)
+UNSEQUENCED = frozenset([u'method', u'dtstamp', u'sequence', u'partstat'])
+
+_templates = {}
+
+
+def _new_uid():
+    # uuid is slow to import and only needed once an event is created
+    import uuid
+    return uuid.uuid4().hex
+
+
+def _parse_template(calstr):
+    """ Split a template into lines and map each field name to the indexes
+    of the lines it appears on.  Parsed templates are cached.
+    """
+    try:
+        return _templates[calstr]
+    except KeyError:
+        pass
+    lines = calstr.splitlines(True)
+    fields = {}
+    for index, line in enumerate(lines):
+        for _, name, _, _ in Formatter().parse(line):
+            if name:
+                fields.setdefault(name, set()).add(index)
+    _templates[calstr] = lines, fields
+    return lines, fields
 
 
 class iCalendar(object):
@@ -40,14 +71,25 @@ class iCalendar(object):
             u'dtend': None,
             u'dtstamp': None,
             u'organizer_email': None,
-            u'uid': uuid.uuid4().hex,
+            u'uid': _new_uid(),
             u'uid_fqdn': '',
             u'attendee_email': None,
             u'description': '',
             u'location': '',
             u'status': None,
             u'summary': None,
+            u'sequence': 0,
+            u'partstat': u'NEEDS-ACTION',
         }
+        self._params = {
+            u'dtstart_tzid': u'',
+            u'dtend_tzid': u'',
+            u'vtimezone': u'',
+        }
+        self._tzinfo = dict.fromkeys([u'dtstart', u'dtend', u'dtstamp'])
+        self._dirty = set()
+        self._lines = None
+        self._lines_template = None
         if config:
             self.from_dict(config)
 
@@ -56,19 +98,19 @@ PRODID:{prodid}
 VERSION:{version}
 CALSCALE:{calscale}
 METHOD:{method}
-BEGIN:VEVENT
-DTSTART:{dtstart}
-DTEND:{dtend}
+{vtimezone}BEGIN:VEVENT
+DTSTART{dtstart_tzid}:{dtstart}
+DTEND{dtend_tzid}:{dtend}
 DTSTAMP:{dtstamp}
 ORGANIZER;CN={organizer_email}:mailto:{organizer_email}
 UID:{uid}@{uid_fqdn}
- ATTENDEE;CUTYPE=INDIVIDUAL;ROLE=REQ-PARTICIPANT;PARTSTAT=NEEDS-ACTION;RSVP=TRUE
+ATTENDEE;CUTYPE=INDIVIDUAL;ROLE=REQ-PARTICIPANT;PARTSTAT={partstat};RSVP=TRUE
  ;CN={attendee_email}:MAILTO:{attendee_email}
 CREATED:{dtstamp}
 DESCRIPTION:{description}
 LAST-MODIFIED:{dtstamp}
 LOCATION:{location}
-SEQUENCE:0
+SEQUENCE:{sequence}
 STATUS:{status}
 SUMMARY:{summary}
 TRANSP:TRANSPARENT
@@ -76,6 +118,13 @@ END:VEVENT
 END:VCALENDAR
 """
 
+    def _set(self, key, value):
+        # Assigning a field its current value is not a change, and must not
+        # make a new revision
+        if self._calendar[key] != value:
+            self._calendar[key] = value
+            self._dirty.add(key)
+
     @property
     def prodid(self):
         return self._calendar[u'prodid']
@@ -97,65 +146,117 @@ END:VCALENDAR
         value = value.upper()
         if value not in defaults.METHODS:
             raise ValueError('%s not in %s' % (value, defaults.METHODS))
-        self._calendar[u'method'] = unicode(value)
+        self._set(u'method', text_type(value))
 
     @method.deleter
     def method(self):
-        self._calendar[u'method'] = None
+        self._set(u'method', None)
+
+    def _get_datetime(self, key):
+        value = self._calendar[key]
+        if value is None:
+            return None
+        tzinfo = self._tzinfo[key]
+        if tzinfo is None:
+            return DateTime.strptime(value, DT_STRF)
+        if self._params.get(key + u'_tzid'):
+            return timezone.localize(
+                DateTime.strptime(value, DT_LOCAL_STRF), tzinfo)
+        return DateTime.strptime(value, DT_STRF).replace(tzinfo=tzinfo)
+
+    def _set_datetime(self, key, value, local=True):
+        """ Naive datetimes are taken to be UTC.  Aware datetimes in UTC
+        are written in UTC form too; other aware datetimes are written as
+        local time with a TZID parameter when ``local`` is True, or
+        converted to UTC otherwise.
+
+        :raise ValueError: If a TZID is needed and the zone has neither an
+        Olson name nor a fixed offset
+        """
+        if not isinstance(value, datetime.datetime):
+            raise TypeError('%s is not of type '
+                            'datetime.datetime' % value)
+        tzinfo = value.tzinfo if value.utcoffset() is not None else None
+        tzid = u''
+        if tzinfo is not None:
+            if local and not timezone.is_utc(tzinfo):
+                tzid = timezone.tzid(tzinfo)
+            else:
+                if not timezone.is_utc(tzinfo):
+                    tzinfo = timezone.UTC
+                value = value.astimezone(tzinfo).replace(tzinfo=None)
+        self._tzinfo[key] = tzinfo
+        if tzid:
+            self._set(key, text_type(value.strftime(DT_LOCAL_STRF)))
+        else:
+            self._set(key, text_type(value.strftime(DT_STRF)))
+        if local:
+            self._set_tzid(key, tzid)
+
+    def _del_datetime(self, key):
+        self._tzinfo[key] = None
+        self._set(key, None)
+        if key + u'_tzid' in self._params:
+            self._set_tzid(key, u'')
+
+    def _set_tzid(self, key, tzid):
+        if any(c in tzid for c in u':;,'):
+            tzid = u'"%s"' % tzid
+        self._set_param(key + u'_tzid', u';TZID=%s' % tzid if tzid else u'')
+
+        # One VTIMEZONE per zone, covering the years of every date using it
+        zones = {}
+        for field in (u'dtstart', u'dtend'):
+            if self._params[field + u'_tzid']:
+                tzinfo = self._tzinfo[field]
+                year = self._get_datetime(field).year
+                zone = zones.setdefault(timezone.tzid(tzinfo),
+                                        [tzinfo, year, year])
+                zone[1] = min(zone[1], year)
+                zone[2] = max(zone[2], year)
+        self._set_param(u'vtimezone', u''.join(
+            timezone.vtimezone(*zones[name]) for name in sorted(zones)))
+
+    def _set_param(self, key, value):
+        if self._params[key] != value:
+            self._params[key] = value
+            self._dirty.add(key)
 
     @property
     def dtstart(self):
-        try:
-            return DateTime.strptime(self._calendar[u'dtstart'], DT_STRF)
-        except TypeError:
-            pass
+        return self._get_datetime(u'dtstart')
 
     @dtstart.setter
     def dtstart(self, value):
-        if not isinstance(value, datetime.datetime):
-            raise TypeError('%s is not of type '
-                            'datetime.datetime' % value)
-        self._calendar[u'dtstart'] = value.strftime(DT_STRF)
+        self._set_datetime(u'dtstart', value)
 
     @dtstart.deleter
     def dtstart(self):
-        self._calendar[u'dtstart'] = None
+        self._del_datetime(u'dtstart')
 
     @property
     def dtend(self):
-        try:
-            return DateTime.strptime(self._calendar[u'dtend'], DT_STRF)
-        except TypeError:
-            pass
+        return self._get_datetime(u'dtend')
 
     @dtend.setter
     def dtend(self, value):
-        if not isinstance(value, datetime.datetime):
-            raise TypeError('%s is not of type '
-                            'datetime.datetime' % value)
-        self._calendar[u'dtend'] = value.strftime(DT_STRF)
+        self._set_datetime(u'dtend', value)
 
     @dtend.deleter
     def dtend(self):
-        self._calendar[u'dtend'] = None
+        self._del_datetime(u'dtend')
 
     @property
     def dtstamp(self):
-        try:
-            return DateTime.strptime(self._calendar[u'dtstamp'], DT_STRF)
-        except TypeError:
-            pass
+        return self._get_datetime(u'dtstamp')
 
     @dtstamp.setter
     def dtstamp(self, value):
-        if not isinstance(value, datetime.datetime):
-            raise TypeError('%s is not of type '
-                            'datetime.datetime' % value)
-        self._calendar[u'dtstamp'] = value.strftime(DT_STRF)
+        self._set_datetime(u'dtstamp', value, local=False)
 
     @dtstamp.deleter
     def dtstamp(self):
-        self._calendar[u'dtstamp'] = None
+        self._del_datetime(u'dtstamp')
 
     @property
     def organizer_email(self):
@@ -164,12 +265,12 @@ END:VCALENDAR
 
     @organizer_email.setter
     def organizer_email(self, value):
-        self._calendar[u'organizer_email'] = unicode(
-            strip_angle_brackets(value))
+        self._set(u'organizer_email', text_type(
+            strip_angle_brackets(value)))
 
     @organizer_email.deleter
     def organizer_email(self):
-        self._calendar[u'organizer_email'] = None
+        self._set(u'organizer_email', None)
 
     @property
     def uid(self):
@@ -177,7 +278,7 @@ END:VCALENDAR
 
     @uid.setter
     def uid(self, value):
-        self._calendar[u'uid'] = unicode(value)
+        self._set(u'uid', text_type(value))
 
     @property
     def uid_fqdn(self):
@@ -185,11 +286,11 @@ END:VCALENDAR
 
     @uid_fqdn.setter
     def uid_fqdn(self, value):
-        self._calendar[u'uid_fqdn'] = unicode(value)
+        self._set(u'uid_fqdn', text_type(value))
 
     @uid_fqdn.deleter
     def uid_fqdn(self):
-        self._calendar[u'uid_fqdn'] = u''
+        self._set(u'uid_fqdn', u'')
 
     @property
     def attendee_email(self):
@@ -198,12 +299,12 @@ END:VCALENDAR
 
     @attendee_email.setter
     def attendee_email(self, value):
-        self._calendar[u'attendee_email'] = unicode(
-            strip_angle_brackets(value))
+        self._set(u'attendee_email', text_type(
+            strip_angle_brackets(value)))
 
     @attendee_email.deleter
     def attendee_email(self):
-        self._calendar[u'attendee_email'] = None
+        self._set(u'attendee_email', None)
 
     @property
     def description(self):
@@ -211,11 +312,11 @@ END:VCALENDAR
 
     @description.setter
     def description(self, value):
-        self._calendar[u'description'] = unicode(value)
+        self._set(u'description', text_type(value))
 
     @description.deleter
     def description(self):
-        self._calendar[u'description'] = u''
+        self._set(u'description', u'')
 
     @property
     def location(self):
@@ -223,11 +324,11 @@ END:VCALENDAR
 
     @location.setter
     def location(self, value):
-        self._calendar[u'location'] = unicode(value)
+        self._set(u'location', text_type(value))
 
     @location.deleter
     def location(self):
-        self._calendar[u'location'] = u''
+        self._set(u'location', u'')
 
     @property
     def status(self):
@@ -238,11 +339,26 @@ END:VCALENDAR
         value = value.upper()
         if value not in defaults.STATUS:
             raise ValueError('%s not in %s' % (value, defaults.STATUS))
-        self._calendar[u'status'] = unicode(value)
+        self._set(u'status', text_type(value))
 
     @status.deleter
     def status(self):
-        self._calendar[u'status'] = None
+        self._set(u'status', None)
+
+    @property
+    def partstat(self):
+        return self._calendar[u'partstat']
+
+    @partstat.setter
+    def partstat(self, value):
+        value = value.upper()
+        if value not in defaults.PARTSTAT:
+            raise ValueError('%s not in %s' % (value, defaults.PARTSTAT))
+        self._set(u'partstat', text_type(value))
+
+    @partstat.deleter
+    def partstat(self):
+        self._set(u'partstat', u'NEEDS-ACTION')
 
     @property
     def summary(self):
@@ -250,11 +366,31 @@ END:VCALENDAR
 
     @summary.setter
     def summary(self, value):
-        self._calendar[u'summary'] = unicode(value)
+        self._set(u'summary', text_type(value))
 
     @summary.deleter
     def summary(self):
-        self._calendar[u'summary'] = None
+        self._set(u'summary', None)
+
+    @property
+    def sequence(self):
+        """ Revision number of the event.  Once the event has been
+        serialized, it is incremented automatically by the next
+        :py:meth:`to_string` after any field other than those in
+        :py:data:`UNSEQUENCED` changes, unless it was set explicitly.
+        """
+        return self._calendar[u'sequence']
+
+    @sequence.setter
+    def sequence(self, value):
+        if not isinstance(value, integer_types) or isinstance(value, bool):
+            raise TypeError('%s is not of type int' % value)
+        if value < 0:
+            raise ValueError('%s is negative' % value)
+        # Always taken as explicit, even if unchanged, so that it overrides
+        # the automatic increment
+        self._calendar[u'sequence'] = value
+        self._dirty.add(u'sequence')
 
     @property
     def attrs(self):
@@ -263,7 +399,7 @@ END:VCALENDAR
 
         :return: list of attribute names as strings
         """
-        return self._calendar.keys()
+        return list(self._calendar.keys())
 
     def from_dict(self, config):
         """ Configure an iCalendar object from a dictionary
@@ -284,6 +420,9 @@ END:VCALENDAR
     def to_string(self):
         """ Serializes an iCalendar event to unicode
 
+        The serialized lines are kept, and later calls re-render only the
+        lines whose fields changed since the previous call.
+
         :return: Unicode
         :raise AttributeError: If required attributes are None
         """
@@ -292,4 +431,23 @@ END:VCALENDAR
                 if val is None:
                     raise AttributeError(
                         'Attribute "%s" should not be None' % key)
-        return self._calstr.format(**self._calendar)
+
+        template, fields = _parse_template(self._calstr)
+        values = dict(self._calendar, **self._params)
+        dirty = self._dirty
+        if self._lines is None or self._lines_template is not self._calstr:
+            self._lines = [line.format(**values) for line in template]
+            self._lines_template = self._calstr
+        elif dirty:
+            if u'sequence' not in dirty and not dirty <= UNSEQUENCED:
+                self._calendar[u'sequence'] += 1
+                values[u'sequence'] += 1
+                dirty.add(u'sequence')
+            indexes = set()
+            for key in dirty:
+                indexes.update(fields.get(key, ()))
+            lines = self._lines
+            for index in indexes:
+                lines[index] = template[index].format(**values)
+        dirty.clear()
+        return u''.join(self._lines)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Timing hooks for rendering and sending.
+
+An observer is any callable accepting ``(stage, seconds, nbytes, error)``.
+It is called once a stage completes, whether or not it succeeded.  The
+stages reported are:
+
+* ``ics_render`` -- :py:meth:`fortnight.iCalendar.to_string`
+* ``mime_build`` -- assembling the MIME message around the event
+* ``connect``, ``ehlo``, ``auth``, ``mail``, ``rcpt``, ``data``, ``quit``
+  -- the SMTP or LMTP conversation in
+  :py:class:`fortnight.transport.SMTPTransport`
+
+``nbytes`` is the size of the output for ``ics_render``, ``mime_build`` and
+``data`` and 0 for the others.  ``error`` is None when the stage succeeded.
+Otherwise it is the name of the exception the stage raised, or, for the
+``mail``, ``rcpt`` and ``data`` commands, ``SMTP`` followed by the error
+reply code, as in ``SMTP550``.
+"""
+
+import bisect
+from timeit import default_timer
+
+DEFAULT_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+    1.0, 2.5, 5.0, 10.0
+)
+
+
+class _Timer(object):
+    __slots__ = ('observer', 'stage', 'nbytes', 'error', '_start')
+
+    def __init__(self, observer, stage, nbytes):
+        self.observer = observer
+        self.stage = stage
+        self.nbytes = nbytes
+        self.error = None
+
+    def __enter__(self):
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = default_timer() - self._start
+        error = self.error if exc_type is None else exc_type.__name__
+        self.observer(self.stage, elapsed, self.nbytes, error)
+
+
+class _NullTimer(object):
+    __slots__ = ('nbytes', 'error')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(observer, stage, nbytes=0):
+    """ Context manager reporting the duration of its block to
+    ``observer``.  When ``observer`` is None this returns a shared no-op
+    object, so disabled instrumentation costs a single function call.
+    Stages that raise are reported with the name of the exception as
+    ``error``, and the exception propagates.
+
+    :param observer: Callable accepting ``(stage, seconds, nbytes, error)``,
+    or None
+    :param stage: Name of the stage being timed
+    :param nbytes: Byte count to report; may also be assigned to the
+    ``nbytes`` attribute of the returned object inside the block
+    """
+    if observer is None:
+        return _NULL_TIMER
+    return _Timer(observer, stage, nbytes)
+
+
+class HistogramObserver(object):
+    """ Observer aggregating stage durations into histograms, which can be
+    exported in the Prometheus text exposition format with
+    :py:meth:`exposition`.  Successful and failed stages are kept apart,
+    under an ``outcome`` label of ``ok`` or ``error``.  Safe to share
+    between threads.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='fortnight'):
+        # Imported here, as every mailer loads this module for timer()
+        import threading
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, seconds, nbytes, error=None):
+        index = bisect.bisect_left(self.buckets, seconds)
+        key = (stage, 'ok' if error is None else 'error')
+        with self._lock:
+            try:
+                stats = self._stages[key]
+            except KeyError:
+                stats = self._stages[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'count': 0,
+                    'sum': 0.0,
+                    'bytes': 0,
+                }
+            stats['buckets'][index] += 1
+            stats['count'] += 1
+            stats['sum'] += seconds
+            stats['bytes'] += nbytes
+
+    def count(self, stage, outcome='ok'):
+        """ Number of observations recorded for ``stage`` with ``outcome``,
+        ``ok`` or ``error``
+        """
+        with self._lock:
+            return self._stages.get((stage, outcome), {}).get('count', 0)
+
+    def exposition(self):
+        """ Render all recorded stages in the Prometheus text format
+
+        :return: str
+        """
+        duration = '%s_stage_duration_seconds' % self.prefix
+        size = '%s_stage_bytes_total' % self.prefix
+        lines = [
+            '# HELP %s Time spent in each render or send stage.' % duration,
+            '# TYPE %s histogram' % duration,
+        ]
+        with self._lock:
+            stages = sorted(self._stages.items())
+            for (stage, outcome), stats in stages:
+                labels = 'stage="%s",outcome="%s"' % (stage, outcome)
+                cumulative = 0
+                for bound, n in zip(self.buckets, stats['buckets']):
+                    cumulative += n
+                    lines.append('%s_bucket{%s,le="%r"} %d'
+                                 % (duration, labels, bound, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d'
+                             % (duration, labels, stats['count']))
+                lines.append('%s_sum{%s} %r'
+                             % (duration, labels, stats['sum']))
+                lines.append('%s_count{%s} %d'
+                             % (duration, labels, stats['count']))
+            lines.append('# HELP %s Bytes produced or sent by each stage.'
+                         % size)
+            lines.append('# TYPE %s counter' % size)
+            for (stage, outcome), stats in stages:
+                lines.append('%s{stage="%s",outcome="%s"} %d'
+                             % (size, stage, outcome, stats['bytes']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A local record of sent invites, so retries do not deliver duplicates.
+
+Assign a :py:class:`SendLedger` to :py:attr:`fortnight.Mailer.ledger` and
+every message accepted by the transport is recorded by event UID, UID
+domain, recipient and SEQUENCE.  Recipients that already received that
+revision of the event are skipped.
+"""
+
+import math
+import time
+import struct
+import hashlib
+import sqlite3
+import threading
+
+from fortnight.utils import strip_angle_brackets, text_type
+
+
+class BloomFilter(object):
+    """ Set membership in a fixed amount of memory, with no false negatives
+    and a false positive rate of about ``error_rate`` while no more than
+    ``capacity`` items have been added.  Items are digests of at least 16
+    bytes, such as those produced by hashlib.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity < 1:
+            raise ValueError('capacity must be positive')
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            self.size / float(capacity) * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest):
+        # Double hashing: position i is h1 + i * h2, from two 64 bit halves
+        h1, h2 = struct.unpack_from('>QQ', digest)
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, digest):
+        bits = self._bits
+        for position in self._positions(digest):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        bits = self._bits
+        for position in self._positions(digest):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SendLedger(object):
+    """ SQLite backed record of sent messages, with an in-memory bloom
+    filter in front of it.  Safe to share between threads.
+
+    Lookups for messages never sent, the common case, are answered from
+    the filter without touching the database; only probable duplicates
+    fall back to an indexed lookup on disk.  ``capacity`` should be at
+    least the number of entries expected; beyond it the filter passes more
+    lookups through to the database but answers stay exact.
+
+    :param path: Path of the SQLite database, created if missing
+    :param capacity: Number of entries the bloom filter is sized for
+    :param error_rate: Target false positive rate of the bloom filter
+    """
+
+    def __init__(self, path, capacity=1000000, error_rate=0.001):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sent ('
+            'key BLOB PRIMARY KEY, uid TEXT, uid_fqdn TEXT, '
+            'recipient TEXT, sequence INTEGER, sent_at REAL)')
+        self._db.commit()
+
+        self._bloom = BloomFilter(capacity, error_rate)
+        for (key,) in self._db.execute('SELECT key FROM sent'):
+            self._bloom.add(bytes(key))
+
+    @staticmethod
+    def key(uid, uid_fqdn, recipient, sequence):
+        """ Digest identifying one revision of an event sent to one
+        recipient.  Recipient addresses are compared case-insensitively.
+        """
+        recipient = strip_angle_brackets(recipient).lower()
+        parts = (uid, uid_fqdn, recipient, text_type(sequence))
+        return hashlib.sha1(u'\0'.join(parts).encode('utf-8')).digest()
+
+    def seen(self, uid, uid_fqdn, recipient, sequence):
+        """ Whether this revision of the event was already sent to
+        ``recipient``
+
+        :return: bool
+        """
+        key = self.key(uid, uid_fqdn, recipient, sequence)
+        if key not in self._bloom:
+            return False
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM sent WHERE key = ?',
+                                   (sqlite3.Binary(key),)).fetchone()
+        return row is not None
+
+    def record(self, uid, uid_fqdn, recipient, sequence):
+        """ Record that this revision of the event was sent to
+        ``recipient``.  Recording an entry twice has no effect.
+        """
+        key = self.key(uid, uid_fqdn, recipient, sequence)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR IGNORE INTO sent VALUES (?, ?, ?, ?, ?, ?)',
+                    (sqlite3.Binary(key), uid, uid_fqdn, recipient, sequence,
+                     time.time()))
+            self._bloom.add(key)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM sent').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
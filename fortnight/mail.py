@@ -16,19 +16,38 @@
 # limitations under the License.
 
 import re
-import smtplib
+from collections import namedtuple
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 
 from fortnight import iCalendar
 from fortnight.exc import ConfigurationError
-from fortnight.utils import strip_angle_brackets
+from fortnight.instrument import timer
+from fortnight.transport import Transport, SMTPTransport
+from fortnight.utils import string_types, strip_angle_brackets
+
+
+class RenderedMessage(namedtuple('RenderedMessage',
+                                 'key email_from email_to message source')):
+    """ A serialized message ready to be handed to a transport.  ``key``
+    identifies the event it carries as a ``(uid, uid_fqdn, sequence)``
+    tuple.  ``source`` holds the values it was rendered from, for the
+    archive, or None.
+    """
+    __slots__ = ()
+
+
+RenderedMessage.__new__.__defaults__ = (None,)
 
 
 class Mailer(object):
     def __init__(self, config=None):
         self._icalendar = None
+        self._transport = None
+        self._observer = None
+        self._ledger = None
+        self._archive = None
         self._config = {}
 
         if config:
@@ -108,6 +127,78 @@ class Mailer(object):
     def icalendar(self):
         self._icalendar = None
 
+    @property
+    def transport(self):
+        return self._transport
+
+    @transport.setter
+    def transport(self, value):
+        if not isinstance(value, Transport):
+            raise TypeError('%s not of type %s' % (value, Transport))
+        self._transport = value
+
+    @transport.deleter
+    def transport(self):
+        self._transport = None
+
+    @property
+    def observer(self):
+        """ Callable receiving ``(stage, seconds, nbytes, error)`` for each
+        render and send stage; see :py:mod:`fortnight.instrument`.  It is
+        passed on to the SMTP transport the mailer creates itself; a
+        transport assigned to :py:attr:`transport` takes its own observer.
+        """
+        return self._observer
+
+    @observer.setter
+    def observer(self, value):
+        if not callable(value):
+            raise TypeError('%s is not callable' % value)
+        self._observer = value
+
+    @observer.deleter
+    def observer(self):
+        self._observer = None
+
+    @property
+    def ledger(self):
+        """ Optional :py:class:`fortnight.ledger.SendLedger`.  When set,
+        recipients that were already sent the same UID and SEQUENCE are
+        skipped, and accepted recipients are recorded.
+        """
+        return self._ledger
+
+    @ledger.setter
+    def ledger(self, value):
+        # Imported here so that rendering alone never loads sqlite3
+        from fortnight.ledger import SendLedger
+        if not isinstance(value, SendLedger):
+            raise TypeError('%s not of type %s' % (value, SendLedger))
+        self._ledger = value
+
+    @ledger.deleter
+    def ledger(self):
+        self._ledger = None
+
+    @property
+    def archive(self):
+        """ Optional :py:class:`fortnight.archive.ArchiveWriter`.  When
+        set, every message the mailer sends is recorded in it, with the
+        recipients that accepted it.
+        """
+        return self._archive
+
+    @archive.setter
+    def archive(self, value):
+        from fortnight.archive import ArchiveWriter
+        if not isinstance(value, ArchiveWriter):
+            raise TypeError('%s not of type %s' % (value, ArchiveWriter))
+        self._archive = value
+
+    @archive.deleter
+    def archive(self):
+        self._archive = None
+
     @property
     def smtp_host(self):
         try:
@@ -130,7 +221,7 @@ class Mailer(object):
         try:
             value = self._config['smtp_port']
         except KeyError:
-            return ConfigurationError('smtp_port not set')
+            raise ConfigurationError('smtp_port not set')
         else:
             return value
 
@@ -153,60 +244,203 @@ class Mailer(object):
         except AssertionError as e:
             raise ConfigurationError(e)
 
-    def send_email(self, ip=None, port=None):
-        self.check_config()
-
+    def _build_message(self, icalendar, email_to):
+        observer = self._observer
+        ical_string = None
+        if icalendar:
+            with timer(observer, 'ics_render') as t:
+                ical_string = icalendar.to_string()
+                t.nbytes = len(ical_string)
+
+        with timer(observer, 'mime_build') as t:
+            message = self._build_mime(icalendar, ical_string, email_to)
+            t.nbytes = len(message)
+        return message
+
+    def _build_mime(self, icalendar, ical_string, email_to,
+                    boundaries=(None, None)):
+        """ :param boundaries: The MIME boundaries of the multipart/mixed
+        and multipart/alternative parts; random when None
+        """
         root = MIMEMultipart()
-        root['To'] = ",".join(self.email_to)
+        root['To'] = ",".join(email_to)
         root['From'] = self.email_from
         root['Subject'] = self.email_subject
 
-        mix = MIMEMultipart('mixed')
+        mix = MIMEMultipart('mixed', boundaries[0])
         root.attach(mix)
 
-        alt = MIMEMultipart('alternative')
+        alt = MIMEMultipart('alternative', boundaries[1])
         mix.attach(alt)
 
         body = MIMEText(self.email_body, 'plain', _charset='utf-8')
         alt.attach(body)
 
-        if self.icalendar:
-            ical_string = self._icalendar.to_string()
-            method = self._icalendar.method
-            mime_text = MIMEText(ical_string.encode('ascii', 'ignore'),
+        if icalendar:
+            method = icalendar.method
+            ical_bytes = ical_string.encode('ascii', 'ignore')
+            mime_text = MIMEText(str(ical_bytes.decode('ascii')),
                                  'calendar; method=%s' % method)
             alt.attach(mime_text)
 
             mime_application = MIMEApplication(
-                ical_string.encode('ascii', 'ignore'),
-                'ics; name="invite.ics"')
+                ical_bytes, 'ics; name="invite.ics"')
             mime_application.add_header('Content-Disposition',
                                         'attachment; filename="invite.ics"')
             mix.attach(mime_application)
 
         parts = mix.as_string().split('MIME-Version: 1.0', 1)
         parts[1] = re.sub('MIME-Version: 1.0\n', '', parts[1])
-        new = 'MIME-Version: 1.0\n'.join(parts)
+        return 'MIME-Version: 1.0\n'.join(parts)
 
-        if not ip or port:
+    def _get_transport(self, ip=None, port=None):
+        transport = self._transport
+        if transport is None or ip or port:
             try:
-                ip = self.smtp_host
-                port = self.smtp_port
+                ip = ip or self.smtp_host
+                port = port or self.smtp_port
             except ConfigurationError:
                 raise ConfigurationError('Specify a port and IP')
+            transport = SMTPTransport(ip, port, observer=self._observer)
+        return transport
+
+    def send_email(self, ip=None, port=None):
+        """ Serialize the attached iCalendar event and send it.
+
+        The message is handed to :py:attr:`transport` when one is set and no
+        ``ip`` and ``port`` are given; otherwise it is sent over SMTP to
+        ``ip`` and ``port``, falling back to ``smtp_host`` and ``smtp_port``.
+
+        :raise ConfigurationError: If the mailer is missing configuration
+        """
+        self.check_config()
+
+        icalendar = self._icalendar
+        transport = self._get_transport(ip, port)
+        self._send(transport, self._render(icalendar, self.email_to))
+
+    def _send(self, transport, item):
+        """ Hand a rendered message to ``transport``, less any recipients
+        the ledger says already have it, then record the recipients that
+        accepted it in the ledger and archive
+
+        :return: False if every recipient was skipped, True otherwise
+        :raise ValueError: If an archive is set and ``item`` was rendered
+        without its source
+        """
+        archive = self._archive
+        if archive is not None and item.source is None:
+            raise ValueError('UID %s was rendered without the source the '
+                             'archive needs' % item.key[0])
+        email_to = item.email_to
+        if isinstance(email_to, string_types):
+            email_to = [email_to]
+
+        ledger = self._ledger
+        if ledger is not None:
+            uid, uid_fqdn, sequence = item.key
+            pending = [addr for addr in email_to
+                       if not ledger.seen(uid, uid_fqdn, addr, sequence)]
+            if not pending:
+                return False
+        else:
+            pending = email_to
+
+        refused = transport.send(item.email_from, pending, item.message)
+        accepted = [addr for addr in pending if addr not in refused]
+        if ledger is not None:
+            for addr in accepted:
+                ledger.record(uid, uid_fqdn, addr, sequence)
+        if archive is not None and accepted:
+            archive.add(item.source, item.message, item.email_from, email_to,
+                        accepted)
+        return True
+
+    def send_many(self, icalendars, ip=None, port=None):
+        """ Send a stream of iCalendar events, each to its own attendee.
+
+        Events are serialized and sent one at a time as they are read from
+        ``icalendars``, so it may be a generator such as those in
+        :py:mod:`fortnight.batch`.  The sender, subject and body come from
+        the mailer's configuration; the recipient of each message is the
+        event's ``attendee_email``.  The transport is chosen as in
+        :py:meth:`send_email`, opened before the first message and closed
+        after the last.
+
+        :param icalendars: Iterable of iCalendar objects
+        :return: Number of messages sent
+        :raise ConfigurationError: If the mailer is missing configuration
+        """
+        try:
+            assert self.email_from, 'Missing email_from'
+            assert self.email_subject, 'Missing email_subject'
+            assert self.email_body, 'Missing email_body'
+        except AssertionError as e:
+            raise ConfigurationError(e)
 
+        return self.deliver((self.render(icalendar)
+                             for icalendar in icalendars), ip, port)
+
+    def render(self, icalendar, keep_source=None):
+        """ Serialize an iCalendar event into a message to its attendee,
+        using the mailer's sender, subject and body
+
+        :param keep_source: Whether the message carries the values it was
+        rendered from, which an archive needs to record it.  Defaults to
+        whether :py:attr:`archive` is set.
+        :return: RenderedMessage
+        """
+        return self._render(icalendar, [icalendar.attendee_email],
+                            keep_source)
+
+    def _render(self, icalendar, email_to, keep_source=None):
+        if isinstance(email_to, string_types):
+            email_to = [email_to]
+        message = self._build_message(icalendar, email_to)
+        key = (icalendar.uid, icalendar.uid_fqdn, icalendar.sequence)
+        if keep_source is None:
+            keep_source = self._archive is not None
+        source = None
+        if keep_source:
+            from fortnight.archive import snapshot
+            source = snapshot(icalendar, self.email_subject, self.email_body)
+        return RenderedMessage(key, self.email_from, email_to, message,
+                               source)
+
+    def deliver(self, rendered, ip=None, port=None, on_error=None,
+                on_sent=None):
+        """ Send already rendered messages, such as those produced by
+        :py:func:`fortnight.render.render_pool`, over a single transport
+        connection.  The transport is chosen as in :py:meth:`send_email`.
+
+        :param rendered: Iterable of RenderedMessage
+        :param on_error: Optional callable receiving ``(item, exception)``
+        when a message cannot be sent.  Delivery then resets the transport
+        and carries on with the next message instead of raising.
+        :param on_sent: Optional callable receiving each item once it is
+        sent, so that progress is known even if delivery stops with an
+        error
+        :return: Number of messages sent, not counting those skipped
+        because the ledger had them already
+        """
+        sent = 0
         try:
-            smtp = smtplib.SMTP(ip, port)
-            if not (ip or port):
-                smtp.connect()
-            smtp.sendmail(self.email_from, self.email_to, new)
-            smtp.quit()
-        except (smtplib.SMTPHeloError,
-                smtplib.SMTPDataError,
-                smtplib.SMTPConnectError,
-                smtplib.SMTPSenderRefused,
-                smtplib.SMTPRecipientsRefused,
-                smtplib.SMTPResponseException,
-                smtplib.SMTPServerDisconnected,
-                smtplib.SMTPAuthenticationError):
-            raise
+            with self._get_transport(ip, port) as transport:
+                for item in rendered:
+                    try:
+                        if not self._send(transport, item):
+                            continue
+                    except Exception as e:
+                        if on_error is None:
+                            raise
+                        on_error(item, e)
+                        transport.reset()
+                        continue
+                    sent += 1
+                    if on_sent is not None:
+                        on_sent(item)
+        finally:
+            # Write out what was archived, even if delivery stopped
+            if self._archive is not None:
+                self._archive.flush()
+        return sent
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Rendering of large invite batches in a pool of worker processes.
+
+MIME assembly and base64 encoding are CPU bound, so they are spread over
+several processes, while sending stays in a single process::
+
+    rendered = render_pool(records, {
+        'email_from': 'organizer@example.com',
+        'email_subject': 'Invitation',
+        'email_body': 'You are invited',
+    })
+    mailer.deliver(rendered)
+
+Records are plain dicts as accepted by
+:py:meth:`fortnight.iCalendar.from_dict`, which are cheap to send to the
+workers.  Each message is addressed to the record's ``attendee_email``
+and returned as ASCII bytes with CRLF line endings, as sent on the wire, so
+that the sending process does not convert it again.  Dot-stuffing is left
+to :py:meth:`smtplib.SMTP.data`, which applies it in one pass over the
+bytes.
+The ledger of the mailer delivering the messages applies as to messages
+it rendered.  For its archive to record them, pass ``archive=True``, so
+that each message carries the values it was rendered from.
+"""
+
+import re
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from fortnight.icalendar import iCalendar
+from fortnight.mail import Mailer
+from fortnight.utils import text_type
+
+_EOL = re.compile(br'\r?\n')
+
+_mailer = None
+_keep_source = False
+
+
+def _init_worker(config, keep_source=False):
+    global _mailer, _keep_source
+    _mailer = Mailer(config)
+    _keep_source = keep_source
+
+
+def wire_format(message):
+    """ Encode a message as ASCII bytes with CRLF line endings, as
+    :py:mod:`smtplib` would before sending it
+    """
+    if isinstance(message, text_type):
+        message = message.encode('ascii')
+    return _EOL.sub(b'\r\n', message)
+
+
+def _render_record(record):
+    rendered = _mailer.render(iCalendar(record), _keep_source)
+    return rendered._replace(message=wire_format(rendered.message))
+
+
+def _render_chunk(records):
+    return [_render_record(record) for record in records]
+
+
+def render_pool(records, config, processes=None, chunksize=100, window=None,
+                archive=False):
+    """ Render event records into messages in worker processes
+
+    Messages are yielded in the order of ``records``.  At most ``window``
+    chunks are read ahead and rendered before the consumer has taken
+    them, so memory stays bounded when sending is slower than rendering,
+    and ``records`` may be an arbitrarily long iterator.  An error
+    rendering any record is raised from the generator and stops the pool.
+
+    :param records: Iterable of dicts of iCalendar attributes
+    :param config: Mailer configuration, with at least ``email_from``,
+    ``email_subject`` and ``email_body``
+    :param processes: Number of worker processes, defaulting to the number
+    of CPUs
+    :param chunksize: Number of records handed to a worker at a time
+    :param window: Number of chunks in flight, defaulting to twice the
+    number of processes
+    :param archive: Whether the messages will be delivered by a mailer with
+    an archive, which needs the values they were rendered from
+    :return: Generator of :py:class:`fortnight.mail.RenderedMessage`, with
+    the message as bytes
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if window is None:
+        window = 2 * processes
+    if window < 1:
+        raise ValueError('window must be positive')
+    records = iter(records)
+    pool = multiprocessing.Pool(processes, _init_worker, (config, archive))
+    try:
+        pending = deque()
+        while True:
+            while len(pending) < window:
+                chunk = list(islice(records, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(_render_chunk, (chunk,)))
+            if not pending:
+                break
+            for rendered in pending.popleft().get():
+                yield rendered
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Ingestion of attendee replies (METHOD:REPLY) to events we sent.
+
+Replies are read from a maildir or an mbox file in one streaming pass,
+matched to stored events by UID through a hash index, and their PARTSTAT
+applied to the events::
+
+    result = ingest('/var/mail/rsvp', events)
+
+Other iTIP methods, such as COUNTER, are skipped.
+"""
+
+import os
+import mailbox
+from collections import namedtuple
+
+from fortnight import defaults
+from fortnight.utils import strip_angle_brackets
+
+CALENDAR_TYPES = ('text/calendar', 'application/ics')
+
+
+class Reply(namedtuple('Reply', 'uid attendee partstat sequence dtstamp')):
+    """ One attendee's answer to an event.  ``uid`` is the full UID as
+    serialized, including the ``@uid_fqdn`` part.
+    """
+    __slots__ = ()
+
+
+class IngestResult(namedtuple('IngestResult', 'applied stale unmatched')):
+    """ Counts of replies applied, ignored because a newer revision of the
+    event or a later reply exists, and not matching any event or attendee
+    """
+    __slots__ = ()
+
+
+def unfold(text):
+    """ Split iCalendar text into logical lines, joining folded lines """
+    lines = []
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and lines:
+            lines[-1] += line[1:]
+        elif line:
+            lines.append(line)
+    return lines
+
+
+def _split_unquoted(text, sep, maxsplit=-1):
+    parts = []
+    start = 0
+    quoted = False
+    for index, char in enumerate(text):
+        if char == '"':
+            quoted = not quoted
+        elif char == sep and not quoted and maxsplit != len(parts):
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return parts
+
+
+def parse_line(line):
+    """ Split a content line into its name, parameters and value
+
+    :return: ``(name, params, value)`` with the name and parameter names
+    upper cased and parameter values unquoted
+    """
+    head, value = (_split_unquoted(line, ':', 1) + [u''])[:2]
+    head = _split_unquoted(head, ';')
+    params = {}
+    for param in head[1:]:
+        key, _, val = param.partition('=')
+        params[key.upper()] = val.strip('"')
+    return head[0].upper(), params, value
+
+
+def _address(value):
+    if value.lower().startswith('mailto:'):
+        value = value[7:]
+    return strip_angle_brackets(value.strip()).lower()
+
+
+def parse_replies(text):
+    """ Parse the replies in one iCalendar payload.  Payloads whose METHOD
+    is not REPLY yield nothing.
+
+    :param text: iCalendar text
+    :return: Generator of Reply
+    """
+    method = None
+    event = None
+    for line in unfold(text):
+        name, params, value = parse_line(line)
+        if name == 'METHOD':
+            method = value.strip().upper()
+        elif name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'uid': None, 'sequence': 0, 'dtstamp': u'',
+                     'attendees': []}
+        elif event is None:
+            continue
+        elif name == 'END' and value.upper() == 'VEVENT':
+            if method == 'REPLY' and event['uid']:
+                for attendee, partstat in event['attendees']:
+                    yield Reply(event['uid'], attendee, partstat,
+                                event['sequence'], event['dtstamp'])
+            event = None
+        elif name == 'UID':
+            event['uid'] = value.strip()
+        elif name == 'SEQUENCE':
+            try:
+                event['sequence'] = int(value)
+            except ValueError:
+                pass
+        elif name == 'DTSTAMP':
+            event['dtstamp'] = value.strip()
+        elif name == 'ATTENDEE':
+            partstat = params.get('PARTSTAT', 'NEEDS-ACTION').upper()
+            if partstat in defaults.PARTSTAT:
+                event['attendees'].append((_address(value), partstat))
+
+
+def calendar_payloads(message):
+    """ The iCalendar text of every calendar part in an email message.
+    Parts repeating an earlier one, as the inline and attached copies of
+    the same invite do, are skipped.
+
+    :param message: email.message.Message
+    :return: Generator of unicode
+    """
+    seen = set()
+    for part in message.walk():
+        if part.get_content_type() not in CALENDAR_TYPES:
+            continue
+        payload = part.get_payload(decode=True)
+        if not payload or payload in seen:
+            continue
+        seen.add(payload)
+        charset = part.get_content_charset() or 'utf-8'
+        try:
+            yield payload.decode(charset, 'replace')
+        except LookupError:
+            yield payload.decode('utf-8', 'replace')
+
+
+def open_mailbox(path):
+    """ Open ``path`` as a maildir if it is a directory, else as mbox """
+    if os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, create=False)
+
+
+def read_replies(path):
+    """ Stream the replies contained in every message of a mailbox
+
+    :return: Generator of Reply
+    """
+    box = open_mailbox(path)
+    try:
+        for message in box:
+            for payload in calendar_payloads(message):
+                for reply in parse_replies(payload):
+                    yield reply
+    finally:
+        box.close()
+
+
+def event_key(event):
+    """ The UID of an iCalendar as it is serialized, and as replies quote
+    it
+    """
+    return u'%s@%s' % (event.uid, event.uid_fqdn)
+
+
+def index_events(events):
+    """ Build a UID index of iCalendar objects for
+    :py:func:`apply_replies`
+
+    :return: dict
+    """
+    return dict((event_key(event), event) for event in events)
+
+
+def apply_replies(replies, index):
+    """ Set the PARTSTAT of each event from replies, in one pass.
+
+    A reply applies when its UID is in ``index`` and its attendee is the
+    event's attendee.  Replies to an older SEQUENCE than the event's, and
+    replies older than one already applied for the same event in this
+    pass, are ignored.  Changing PARTSTAT does not increment SEQUENCE.
+
+    :param replies: Iterable of Reply
+    :param index: Dict of UIDs to iCalendar objects, as built by
+    :py:func:`index_events`
+    :return: IngestResult
+    """
+    applied = stale = unmatched = 0
+    latest = {}
+    for reply in replies:
+        event = index.get(reply.uid)
+        if event is None or reply.attendee != (
+                event.attendee_email or u'').lower():
+            unmatched += 1
+            continue
+        if (reply.sequence < event.sequence or
+                reply.dtstamp < latest.get(reply.uid, u'')):
+            stale += 1
+            continue
+        latest[reply.uid] = reply.dtstamp
+        event.partstat = reply.partstat
+        applied += 1
+    return IngestResult(applied, stale, unmatched)
+
+
+def ingest(path, events):
+    """ Apply every reply in the mailbox at ``path`` to ``events``
+
+    :param path: Path of a maildir or mbox file
+    :param events: Dict of UIDs to iCalendar objects, or an iterable of
+    iCalendar objects to index
+    :return: IngestResult
+    """
+    if not isinstance(events, dict):
+        events = index_events(events)
+    return apply_replies(read_replies(path), events)
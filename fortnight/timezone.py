@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Time zone helpers for aware datetimes.
+
+Works with any :py:class:`datetime.tzinfo` implementation (pytz, dateutil,
+zoneinfo, ...).  Transitions are found by probing the zone, so generating a
+VTIMEZONE is comparatively slow; the results are cached per zone and year
+range by :py:func:`vtimezone`.
+"""
+
+import datetime
+from datetime import datetime as DateTime
+
+from fortnight.utils import DT_LOCAL_STRF, text_type
+
+UTC_NAMES = frozenset([
+    'UTC', 'Etc/UTC', 'Universal', 'Etc/Universal', 'Zulu', 'Etc/Zulu',
+    'GMT', 'Etc/GMT', 'Z',
+])
+
+_ZERO = datetime.timedelta(0)
+_DAY = datetime.timedelta(days=1)
+_SECOND = datetime.timedelta(seconds=1)
+
+
+class _UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return _ZERO
+
+    def dst(self, dt):
+        return _ZERO
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def __repr__(self):
+        return '<UTC>'
+
+
+UTC = _UTC()
+
+_vtimezones = {}
+
+
+def _olson_name(tzinfo):
+    """ The Olson name of ``tzinfo`` as pytz (``zone``), zoneinfo (``key``)
+    or dateutil (``_filename``) record it, or None
+    """
+    name = getattr(tzinfo, 'zone', None) or getattr(tzinfo, 'key', None)
+    if name:
+        return name
+    filename = getattr(tzinfo, '_filename', None)
+    if filename:
+        # dateutil keeps the path of the zone file it read
+        _, marker, name = filename.replace('\\', '/').rpartition('zoneinfo/')
+        if marker or not name.startswith('/'):
+            return name
+    return None
+
+
+def _fixed_offset(tzinfo):
+    # By the tzinfo convention, only zones with a single offset answer
+    # utcoffset(None)
+    try:
+        return tzinfo.utcoffset(None)
+    except (TypeError, AttributeError, ValueError):
+        return None
+
+
+def tzid(tzinfo):
+    """ The identifier used for ``tzinfo`` in TZID parameters: its Olson
+    name, or for an unnamed zone with a fixed offset a name such as
+    ``UTC+0530``.  Abbreviations such as ``CST`` are never used, as they are
+    ambiguous.
+
+    :return: unicode
+    :raise ValueError: If ``tzinfo`` is neither named nor a fixed offset
+    """
+    name = _olson_name(tzinfo)
+    if name:
+        return text_type(name)
+    offset = _fixed_offset(tzinfo)
+    if offset is None:
+        raise ValueError('%r has no Olson name and no fixed offset; use a '
+                         'pytz, zoneinfo or dateutil zone' % tzinfo)
+    return text_type('UTC' + _format_offset(offset))
+
+
+def is_utc(tzinfo):
+    """ Whether ``tzinfo`` is UTC, going by its Olson name or, for unnamed
+    zones, a fixed offset of zero
+    """
+    if tzinfo is UTC:
+        return True
+    name = _olson_name(tzinfo)
+    if name:
+        return name in UTC_NAMES
+    return _fixed_offset(tzinfo) == _ZERO
+
+
+def localize(value, tzinfo):
+    """ Attach ``tzinfo`` to the naive local datetime ``value`` """
+    try:
+        return tzinfo.localize(value)
+    except AttributeError:
+        return value.replace(tzinfo=tzinfo)
+
+
+def _observance(tzinfo, when):
+    local = when.astimezone(tzinfo)
+    # The wall clock difference, rather than local.utcoffset(), stays right
+    # in the repeated hour for tzinfo classes that cannot tell it apart.
+    offset = local.replace(tzinfo=None) - when.replace(tzinfo=None)
+    return offset, local.tzname(), bool(local.dst())
+
+
+def transitions(tzinfo, first_year, last_year):
+    """ Find the offset changes of ``tzinfo`` between the start of
+    ``first_year`` and the end of ``last_year``, to the second.
+
+    :return: List of ``(utc_datetime, offset_from, offset_to, tzname,
+    is_dst)`` tuples
+    """
+    start = DateTime(first_year, 1, 1, tzinfo=UTC)
+    end = DateTime(last_year + 1, 1, 1, tzinfo=UTC)
+    found = []
+    before = start
+    observance = _observance(tzinfo, before)
+    while before < end:
+        after = before + _DAY
+        next_observance = _observance(tzinfo, after)
+        if next_observance[0] != observance[0]:
+            low, high = before, after
+            while high - low > _SECOND:
+                middle = low + (high - low) // 2
+                if _observance(tzinfo, middle)[0] == observance[0]:
+                    low = middle
+                else:
+                    high = middle
+            offset_to, name, dst = _observance(tzinfo, high)
+            found.append((high, observance[0], offset_to, name, dst))
+        before, observance = after, next_observance
+    return found
+
+
+def _format_offset(offset):
+    seconds = offset.days * 86400 + offset.seconds
+    sign = '-' if seconds < 0 else '+'
+    minutes, seconds = divmod(abs(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if seconds:
+        return '%s%02d%02d%02d' % (sign, hours, minutes, seconds)
+    return '%s%02d%02d' % (sign, hours, minutes)
+
+
+def _component(is_dst, onset, offset_from, offset_to, name):
+    kind = 'DAYLIGHT' if is_dst else 'STANDARD'
+    lines = [
+        'BEGIN:%s' % kind,
+        'DTSTART:%s' % onset.strftime(DT_LOCAL_STRF),
+        'TZOFFSETFROM:%s' % _format_offset(offset_from),
+        'TZOFFSETTO:%s' % _format_offset(offset_to),
+    ]
+    if name:
+        lines.append('TZNAME:%s' % name)
+    lines.append('END:%s' % kind)
+    return lines
+
+
+def vtimezone(tzinfo, first_year, last_year):
+    """ Render a VTIMEZONE component describing ``tzinfo`` for events
+    between ``first_year`` and ``last_year``, inclusive.  Results are
+    cached by TZID and year range.
+
+    :return: unicode, ending with a newline
+    """
+    key = (tzid(tzinfo), first_year, last_year)
+    try:
+        return _vtimezones[key]
+    except KeyError:
+        pass
+
+    start = DateTime(first_year, 1, 1, tzinfo=UTC)
+    offset, name, dst = _observance(tzinfo, start)
+    lines = ['BEGIN:VTIMEZONE', 'TZID:%s' % key[0]]
+    lines.extend(_component(dst, start.replace(tzinfo=None) + offset,
+                            offset, offset, name))
+    for when, offset_from, offset_to, name, dst in transitions(
+            tzinfo, first_year, last_year):
+        onset = when.replace(tzinfo=None) + offset_from
+        lines.extend(_component(dst, onset, offset_from, offset_to, name))
+    lines.append('END:VTIMEZONE')
+
+    text = u'\n'.join(lines) + u'\n'
+    _vtimezones[key] = text
+    return text
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import errno
+import socket
+import smtplib
+
+from fortnight.instrument import timer
+from fortnight.utils import string_types
+
+
+def _header_value(value):
+    # Envelope addresses come from callers; keep them on a single line
+    return ' '.join(value.splitlines())
+
+
+def _timed(observer, stage, command, sized=False):
+    """ Wrap an SMTP command method so that each call is reported to
+    ``observer``, along with error replies
+    """
+    def wrapper(*args, **kwargs):
+        with timer(observer, stage, len(args[0]) if sized else 0) as t:
+            code, resp = command(*args, **kwargs)
+            if code >= 400:
+                t.error = 'SMTP%d' % code
+        return code, resp
+    return wrapper
+
+
+class Transport(object):
+    """ Base class for the objects :py:class:`fortnight.Mailer` hands
+    serialized messages to.
+
+    A transport may be used for a single message, in which case
+    :py:meth:`send` takes care of any connection setup and teardown, or
+    opened once with :py:meth:`open` (or a ``with`` block) and reused for
+    many messages until :py:meth:`close` is called.
+    """
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def reset(self):
+        """ Recover after a failed :py:meth:`send`, so that the transport
+        can be used for the next message
+        """
+        pass
+
+    def send(self, email_from, email_to, message):
+        """ Deliver a single message
+
+        :param email_from: Envelope sender address
+        :param email_to: List of envelope recipient addresses
+        :param message: The fully serialized message, as a string or as
+        ASCII bytes with CRLF line endings
+        :return: Dict of the recipients that were refused, keyed by address;
+        empty when all were accepted
+        """
+        raise NotImplementedError
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SMTPTransport(Transport):
+    """ Delivers messages to an SMTP relay
+
+    :param host: Relay host name or address
+    :param port: Relay port
+    :param username: Log in with this user name after EHLO, if given
+    :param password: Password for ``username``
+    :param observer: Optional callable receiving stage timings, see
+    :py:mod:`fortnight.instrument`
+    """
+
+    def __init__(self, host, port=smtplib.SMTP_PORT, username=None,
+                 password=None, observer=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.observer = observer
+        self._smtp = None
+
+    @property
+    def connected(self):
+        return self._smtp is not None
+
+    def _client(self):
+        return smtplib.SMTP()
+
+    def _connect(self):
+        observer = self.observer
+        smtp = self._client()
+        with timer(observer, 'connect'):
+            smtp.connect(self.host, self.port)
+        with timer(observer, 'ehlo'):
+            smtp.ehlo_or_helo_if_needed()
+        if self.username:
+            with timer(observer, 'auth'):
+                smtp.login(self.username, self.password)
+        if observer is not None:
+            # smtplib.SMTP.sendmail issues each command through these
+            # methods, so wrapping them times the conversation without
+            # changing it.
+            smtp.mail = _timed(observer, 'mail', smtp.mail)
+            smtp.rcpt = _timed(observer, 'rcpt', smtp.rcpt)
+            smtp.data = _timed(observer, 'data', smtp.data, sized=True)
+        return smtp
+
+    def _quit(self, smtp):
+        """ End the session, dropping the connection if QUIT fails.  By
+        then any message sent was accepted, so the failure is not raised.
+        """
+        try:
+            with timer(self.observer, 'quit'):
+                smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            smtp.close()
+
+    def _sendmail(self, smtp, email_from, email_to, message):
+        return smtp.sendmail(email_from, email_to, message)
+
+    def open(self):
+        if self._smtp is None:
+            self._smtp = self._connect()
+
+    def close(self):
+        if self._smtp is not None:
+            smtp, self._smtp = self._smtp, None
+            self._quit(smtp)
+
+    def reset(self):
+        """ Replace the open connection, if any, with a new one.  The old
+        connection may be broken, so errors closing it are ignored.
+        """
+        if self._smtp is None:
+            return
+        smtp, self._smtp = self._smtp, None
+        self._quit(smtp)
+        self.open()
+
+    def send(self, email_from, email_to, message):
+        """ Deliver a message over SMTP.  If the transport has not been
+        opened, a connection is made for this message alone.
+
+        :return: Dict of refused recipients, as smtplib.SMTP.sendmail
+        :raise smtplib.SMTPException: If the relay rejects the message
+        """
+        if self._smtp is not None:
+            return self._sendmail(self._smtp, email_from, email_to, message)
+
+        smtp = self._connect()
+        try:
+            return self._sendmail(smtp, email_from, email_to, message)
+        finally:
+            self._quit(smtp)
+
+
+def _rset(smtp):
+    try:
+        smtp.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+class LMTPTransport(SMTPTransport):
+    """ Delivers messages to an LMTP server, such as a local MTA or MDA.
+    ``host`` may be a path to a UNIX domain socket.
+
+    An LMTP server answers the end of DATA once for each accepted
+    recipient (RFC 2033).  Each of these replies is read, so that the
+    connection stays in step for the next message, and recipients
+    rejected there are returned with those refused at RCPT.
+    """
+
+    def __init__(self, host, port=smtplib.LMTP_PORT, username=None,
+                 password=None, observer=None):
+        super(LMTPTransport, self).__init__(host, port, username, password,
+                                            observer)
+
+    def _client(self):
+        return smtplib.LMTP()
+
+    def _sendmail(self, smtp, email_from, email_to, message):
+        if isinstance(email_to, string_types):
+            email_to = [email_to]
+        smtp.ehlo_or_helo_if_needed()
+        code, resp = smtp.mail(email_from)
+        if code != 250:
+            _rset(smtp)
+            raise smtplib.SMTPSenderRefused(code, resp, email_from)
+        refused = {}
+        accepted = []
+        for addr in email_to:
+            code, resp = smtp.rcpt(addr)
+            if code in (250, 251):
+                accepted.append(addr)
+            else:
+                refused[addr] = (code, resp)
+        if not accepted:
+            _rset(smtp)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        replies = [smtp.data(message)]
+        replies.extend(smtp.getreply() for _ in accepted[1:])
+        for addr, (code, resp) in zip(accepted, replies):
+            if code != 250:
+                refused[addr] = (code, resp)
+        if len(refused) == len(email_to):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+
+class MaildirTransport(Transport):
+    """ Writes each message into a maildir, to be picked up in batches by
+    a local MTA or another process.  Messages are written to ``tmp`` and
+    renamed into ``new``, so readers never see a partial message.
+
+    The envelope is recorded in a ``Return-Path`` header holding the sender
+    and one ``X-Original-To`` header per recipient, as local delivery
+    agents write them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._maildir = None
+
+    def open(self):
+        if self._maildir is None:
+            import mailbox
+            # Created here rather than by mailbox, which fails when several
+            # senders create the same maildir at once
+            for path in (self.path, os.path.join(self.path, 'tmp'),
+                         os.path.join(self.path, 'new'),
+                         os.path.join(self.path, 'cur')):
+                try:
+                    os.mkdir(path, 0o700)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self._maildir = mailbox.Maildir(self.path, factory=None,
+                                            create=False)
+
+    def close(self):
+        self._maildir = None
+
+    def send(self, email_from, email_to, message):
+        """ Store a message in the maildir
+
+        :return: Empty dict, as no recipient is refused
+        """
+        self.open()
+        if isinstance(email_to, string_types):
+            email_to = [email_to]
+        envelope = ['Return-Path: <%s>\n' % _header_value(email_from)]
+        envelope.extend('X-Original-To: %s\n' % _header_value(addr)
+                        for addr in email_to)
+        envelope = ''.join(envelope)
+        if isinstance(message, bytes):
+            # Stored with the local line endings, as mailbox does for text
+            message = message.replace(b'\r\n', b'\n')
+        if not isinstance(envelope, type(message)):
+            # Bytes from render_pool, or Python 2 with unicode addresses
+            envelope = envelope.encode('utf-8')
+        self._maildir.add(envelope + message)
+        return {}
+
+
+class MemoryTransport(Transport):
+    """ Keeps every message in memory.  Useful in tests and to measure
+    message rendering without any I/O.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, email_from, email_to, message):
+        self.messages.append((email_from, email_to, message))
+        return {}
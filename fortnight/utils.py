@@ -15,11 +15,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+try:
+    text_type = unicode
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    text_type = str
+    string_types = str
+    integer_types = (int,)
+
 DT_STRF = '%Y%m%dT%H%M%SZ'
+DT_LOCAL_STRF = '%Y%m%dT%H%M%S'
 
 
 def wrap_in_angle_brackets(value):
-    if isinstance(value, unicode):
+    if isinstance(value, text_type):
         return u"<%s>" % value
     elif isinstance(value, str):
         return "<%s>" % value
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 # Copyright 2014 Paul Durivage <pauldurivage+git@gmail.com>
 #
@@ -23,4 +23,9 @@ setup(
     author='Paul Durivage',
     author_email='pauldurivage@gmail.com',
     description='Generates and Emails iCalendar events',
+    entry_points={
+        'console_scripts': [
+            'fortnight = fortnight.cli:main',
+        ],
+    },
 )
@@ -15,13 +15,176 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
+import json
+import zlib
+import shutil
+import socket
+import mailbox
+import subprocess
+import smtplib
+import tempfile
 import unittest
 import datetime
-from mock import patch
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
 
 from fortnight import iCalendar
 from fortnight import Mailer
+from fortnight import batch
+from fortnight import cli
+from fortnight import replies
+from fortnight import timezone
+from fortnight.render import render_pool, wire_format
+from fortnight.archive import ArchiveReader, ArchiveWriter
 from fortnight.exc import ConfigurationError
+from fortnight.instrument import HistogramObserver, timer
+from fortnight.ledger import BloomFilter, SendLedger
+from fortnight.utils import text_type
+from fortnight.transport import (LMTPTransport, MaildirTransport,
+                                 MemoryTransport, SMTPTransport)
+
+
+class Berlin(datetime.tzinfo):
+    """ Central European Time with the EU daylight saving rules """
+    zone = 'Europe/Berlin'
+
+    def _last_sunday(self, year, month):
+        day = datetime.datetime(year, month + 1, 1) - datetime.timedelta(1)
+        return day - datetime.timedelta(days=(day.weekday() + 1) % 7)
+
+    def dst(self, dt):
+        if dt is None:
+            return datetime.timedelta(0)
+        start = self._last_sunday(dt.year, 3).replace(hour=2)
+        end = self._last_sunday(dt.year, 10).replace(hour=2)
+        if start <= dt.replace(tzinfo=None) < end:
+            return datetime.timedelta(hours=1)
+        return datetime.timedelta(0)
+
+    def utcoffset(self, dt):
+        return datetime.timedelta(hours=1) + self.dst(dt)
+
+    def tzname(self, dt):
+        return 'CEST' if self.dst(dt) else 'CET'
+
+
+class London(Berlin):
+    """ Shaped like a dateutil zone: no ``zone`` attribute, the path of its
+    zone file, and no offset without a datetime
+    """
+    zone = None
+    _filename = '/usr/share/zoneinfo/Europe/London'
+
+    def utcoffset(self, dt):
+        if dt is None:
+            return None
+        return self.dst(dt)
+
+    def tzname(self, dt):
+        return 'BST' if self.dst(dt) else 'GMT'
+
+
+class Fixed(datetime.tzinfo):
+    """ An unnamed zone with a fixed offset """
+
+    def __init__(self, minutes):
+        self.offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return 'CST'
+
+
+DTSTART = datetime.datetime(2014, 12, 1, 7, 30)
+
+
+def event_config(i, **overrides):
+    """ Configuration of the ``i``-th test event, as accepted by
+    iCalendar and render_pool
+    """
+    config = {
+        'uid': 'uid%d' % i,
+        'method': 'REQUEST',
+        'dtstart': DTSTART,
+        'dtend': DTSTART,
+        'dtstamp': DTSTART,
+        'organizer_email': 'organizer@example.com',
+        'attendee_email': '%d@example.com' % i,
+        'status': 'CONFIRMED',
+        'summary': 'Meeting %d' % i,
+    }
+    config.update(overrides)
+    return config
+
+
+class StubSMTP(smtplib.SMTP):
+    """ smtplib client talking to a scripted server instead of a socket.
+    Recipients in ``refuse`` get a 550 reply and ``data_reply`` answers the
+    end of DATA.  ``data_replies``, if given, lists the replies to the end
+    of DATA in the order they are read, as an LMTP server sends one per
+    recipient.
+    """
+
+    def __init__(self, refuse=(), data_reply=(250, b'queued'),
+                 data_replies=None):
+        smtplib.SMTP.__init__(self, local_hostname='localhost')
+        self.sock = self.file = None
+        self.refuse = refuse
+        self.data_reply = data_reply
+        self.data_replies = data_replies
+        self.sent = []
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        return 220, b'stub ready'
+
+    def send(self, s):
+        if isinstance(s, bytes) and not isinstance(s, str):
+            s = s.decode('latin-1')
+        self.sent.append(s)
+
+    def getreply(self):
+        last = self.sent[-1]
+        verb = last.split(' ', 1)[0].strip().lower()
+        if last.endswith('\r\n.\r\n'):
+            if self.data_replies is not None:
+                return self.data_replies.pop(0)
+            return self.data_reply
+        if verb == 'ehlo':
+            return 250, b'stub\nSIZE 1000000'
+        if verb == 'rcpt' and any(addr in last for addr in self.refuse):
+            return 550, b'no such user'
+        if verb == 'data':
+            return 354, b'go ahead'
+        if verb == 'quit':
+            return 221, b'bye'
+        return 250, b'OK'
+
+
+class StubTransport(SMTPTransport):
+    def __init__(self, client, **kwargs):
+        super(StubTransport, self).__init__('localhost', **kwargs)
+        self.client = client
+
+    def _client(self):
+        return self.client
+
+
+class StubLMTPTransport(LMTPTransport):
+    def __init__(self, client, **kwargs):
+        super(StubLMTPTransport, self).__init__('localhost', **kwargs)
+        self.client = client
+
+    def _client(self):
+        return self.client
 
 
 class TestIcal(unittest.TestCase):
@@ -72,7 +235,7 @@ string"""
     def test_set_attr_not_unicode(self):
         self.ical.description = "Not unicode"
         description = self.ical.description
-        self.assertIsInstance(description, unicode)
+        self.assertIsInstance(description, text_type)
 
     def test_attr_not_in_defaults(self):
         def _callable():
@@ -149,13 +312,168 @@ string"""
         self.ical.summary = u'FREE TEXT HERE'
 
         ical_str = self.ical.to_string()
-        self.assertIsInstance(ical_str, unicode)
+        self.assertIsInstance(ical_str, text_type)
 
         def _callable():
             self.ical._calendar[u'summary'] = None
             self.ical.to_string()
         self.assertRaises(AttributeError, _callable)
 
+    def _populate(self, ical):
+        dtnow = datetime.datetime(2014, 12, 1, 7, 30)
+        ical.from_dict({
+            'method': u'REQUEST',
+            'dtstart': dtnow,
+            'dtend': dtnow + datetime.timedelta(hours=1),
+            'dtstamp': dtnow,
+            'organizer_email': u'organizer@example.com',
+            'attendee_email': u'attendee@example.com',
+            'status': u'CONFIRMED',
+            'summary': u'FREE TEXT HERE',
+        })
+        return ical
+
+    def test_sequence(self):
+        self.assertEqual(self.ical.sequence, 0)
+        self.ical.sequence = 3
+        self.assertEqual(self.ical.sequence, 3)
+        for value in ('1', 1.0, True):
+            self.assertRaises(TypeError, setattr, self.ical, 'sequence',
+                              value)
+        self.assertRaises(ValueError, setattr, self.ical, 'sequence', -1)
+
+    def test_sequence_increments_on_change(self):
+        ical = self._populate(self.ical)
+        self.assertIn(u'SEQUENCE:0\n', ical.to_string())
+        self.assertIn(u'SEQUENCE:0\n', ical.to_string())
+
+        ical.location = u'Room 101'
+        ical.summary = u'Moved'
+        ical_str = ical.to_string()
+        self.assertEqual(ical.sequence, 1)
+        self.assertIn(u'SEQUENCE:1\n', ical_str)
+        self.assertIn(u'LOCATION:Room 101\n', ical_str)
+
+        ical.dtstamp = datetime.datetime(2014, 12, 2)
+        ical.method = u'PUBLISH'
+        ical.to_string()
+        self.assertEqual(ical.sequence, 1)
+
+        ical.status = u'CANCELLED'
+        ical.sequence = 7
+        self.assertIn(u'SEQUENCE:7\n', ical.to_string())
+
+        # Assigning unchanged values is not a new revision
+        ical.status = ical.status
+        ical.from_dict({'location': u'Room 101', 'summary': u'Moved'})
+        self.assertIn(u'SEQUENCE:7\n', ical.to_string())
+
+    def test_partstat(self):
+        ical = self._populate(self.ical)
+        self.assertEqual(ical.partstat, u'NEEDS-ACTION')
+        ical.to_string()
+        ical.partstat = u'accepted'
+        ical_str = ical.to_string()
+        self.assertIn(u'PARTSTAT=ACCEPTED;', ical_str)
+        self.assertEqual(ical.sequence, 0)
+        self.assertRaises(ValueError, setattr, ical, 'partstat', u'MAYBE')
+        del ical.partstat
+        self.assertEqual(ical.partstat, u'NEEDS-ACTION')
+
+    def test_incremental_render_matches_full_render(self):
+        ical = self._populate(self.ical)
+        ical.to_string()
+        ical.dtstart = datetime.datetime(2015, 1, 5, 9)
+        ical.attendee_email = u'someone@example.com'
+        ical.dtstamp = datetime.datetime(2015, 1, 1)
+        incremental = ical.to_string()
+
+        fresh = self._populate(iCalendar())
+        fresh.uid = ical.uid
+        fresh.dtstart = datetime.datetime(2015, 1, 5, 9)
+        fresh.attendee_email = u'someone@example.com'
+        fresh.dtstamp = datetime.datetime(2015, 1, 1)
+        fresh.sequence = 1
+        self.assertEqual(incremental, fresh.to_string())
+
+    def test_aware_datetime(self):
+        berlin = Berlin()
+        start = datetime.datetime(2014, 12, 1, 7, 30, tzinfo=berlin)
+        ical = self._populate(self.ical)
+        ical.dtstart = start
+        self.assertEqual(ical.dtstart, start)
+        self.assertIs(ical.dtstart.tzinfo, berlin)
+
+        ical_str = ical.to_string()
+        self.assertIn(u'DTSTART;TZID=Europe/Berlin:20141201T073000\n',
+                      ical_str)
+        self.assertIn(u'DTEND:20141201T083000Z\n', ical_str)
+        self.assertIn(u'METHOD:REQUEST\nBEGIN:VTIMEZONE\n'
+                      u'TZID:Europe/Berlin\n', ical_str)
+        self.assertIn(u'BEGIN:DAYLIGHT\nDTSTART:20140330T020000\n'
+                      u'TZOFFSETFROM:+0100\nTZOFFSETTO:+0200\n'
+                      u'TZNAME:CEST\nEND:DAYLIGHT\n', ical_str)
+        self.assertIn(u'BEGIN:STANDARD\nDTSTART:20141026T030000\n'
+                      u'TZOFFSETFROM:+0200\nTZOFFSETTO:+0100\n'
+                      u'TZNAME:CET\nEND:STANDARD\n', ical_str)
+        self.assertIn(u'END:VTIMEZONE\nBEGIN:VEVENT\n', ical_str)
+
+        ical.dtend = datetime.datetime(2015, 1, 5, 9, tzinfo=berlin)
+        ical_str = ical.to_string()
+        self.assertEqual(ical_str.count(u'BEGIN:VTIMEZONE'), 1)
+        self.assertIn(u'BEGIN:STANDARD\nDTSTART:20151025T030000\n', ical_str)
+
+        del ical.dtstart
+        del ical.dtend
+        self.assertIs(ical.dtstart, None)
+        ical.dtstart = datetime.datetime(2014, 12, 1, 7, 30)
+        ical.dtend = datetime.datetime(2014, 12, 1, 8, 30)
+        ical_str = ical.to_string()
+        self.assertNotIn(u'VTIMEZONE', ical_str)
+        self.assertIn(u'DTSTART:20141201T073000Z\n', ical_str)
+
+    def test_aware_datetime_utc(self):
+        start = datetime.datetime(2014, 12, 1, 7, 30, tzinfo=timezone.UTC)
+        self.ical.dtstart = start
+        self.assertEqual(self.ical.dtstart, start)
+        self.assertEqual(self.ical._calendar[u'dtstart'], u'20141201T073000Z')
+        self.assertEqual(self.ical._params[u'dtstart_tzid'], u'')
+
+        stamp = datetime.datetime(2014, 7, 1, 12, tzinfo=Berlin())
+        self.ical.dtstamp = stamp
+        self.assertEqual(self.ical._calendar[u'dtstamp'], u'20140701T100000Z')
+        self.assertEqual(self.ical.dtstamp, stamp)
+
+    def test_tzid(self):
+        london = London()
+        self.assertEqual(timezone.tzid(london), u'Europe/London')
+        self.assertFalse(timezone.is_utc(london))
+        self.ical.dtstart = datetime.datetime(2015, 7, 1, 9, tzinfo=london)
+        self.assertEqual(self.ical._calendar[u'dtstart'], u'20150701T090000')
+        self.assertEqual(self.ical._params[u'dtstart_tzid'],
+                         u';TZID=Europe/London')
+
+        # Unnamed zones are identified by their offset, never their
+        # abbreviation
+        self.assertEqual(timezone.tzid(Fixed(330)), u'UTC+0530')
+        self.assertEqual(timezone.tzid(Fixed(-300)), u'UTC-0500')
+        self.assertNotEqual(timezone.vtimezone(Fixed(-300), 2014, 2014),
+                            timezone.vtimezone(Fixed(-360), 2014, 2014))
+        self.assertTrue(timezone.is_utc(Fixed(0)))
+
+        unnamed = London()
+        unnamed._filename = None
+        self.assertRaises(ValueError, timezone.tzid, unnamed)
+        self.assertRaises(ValueError, setattr, self.ical, 'dtstart',
+                          datetime.datetime(2015, 7, 1, 9, tzinfo=unnamed))
+
+    def test_vtimezone_cached(self):
+        berlin = Berlin()
+        text = timezone.vtimezone(berlin, 2014, 2015)
+        self.assertIs(timezone.vtimezone(berlin, 2014, 2015), text)
+        self.assertEqual(text.count(u'BEGIN:DAYLIGHT'), 2)
+        self.assertEqual(len(timezone.transitions(berlin, 2014, 2015)), 4)
+
 
 class TestMail(unittest.TestCase):
     def setUp(self):
@@ -262,6 +580,1068 @@ class TestMail(unittest.TestCase):
         result = self.mailer.send_email()
         self.assertIs(result, None)
 
+    @patch('smtplib.SMTP')
+    def test_send_email_explicit_ip_and_port(self, PatchedSmtplib):
+        smtp = PatchedSmtplib.return_value
+        smtp.sendmail.return_value = {}
+        self.mailer.attach(self.ical)
+        # A transport is set, but an explicit relay takes precedence
+        self.mailer.transport = MemoryTransport()
+        self.mailer.send_email('relay.example.com', 2525)
+        smtp.connect.assert_called_once_with('relay.example.com', 2525)
+
+        # Each missing argument falls back to the configuration on its own
+        self.mailer.smtp_host = 'localhost'
+        self.mailer.smtp_port = 25
+        self.mailer.send_many([self.ical], port=2525)
+        self.assertEqual(smtp.connect.call_args[0], ('localhost', 2525))
+        self.mailer.deliver([self.mailer.render(self.ical)],
+                            'relay.example.com')
+        self.assertEqual(smtp.connect.call_args[0],
+                         ('relay.example.com', 25))
+
+        del self.mailer.smtp_port
+        self.assertRaises(ConfigurationError, getattr, self.mailer,
+                          'smtp_port')
+        self.assertRaises(ConfigurationError, self.mailer.send_email,
+                          'relay.example.com')
+
+    def test_import_is_light(self):
+        # Render workers import the mailer; what only sending needs is
+        # loaded when it is used
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, fortnight.mail; '
+            'print(" ".join(sorted(sys.modules)))'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).decode('ascii').split()
+        for module in ('sqlite3', 'zlib', 'mailbox', 'fortnight.ledger',
+                       'fortnight.archive'):
+            self.assertNotIn(module, loaded)
+
+    def test_transport(self):
+        def _callable():
+            self.mailer.transport = object()
+        self.assertRaises(TypeError, _callable)
+
+        transport = MemoryTransport()
+        self.mailer.transport = transport
+        self.mailer.attach(self.ical)
+        self.mailer.send_email()
+        self.assertEqual(len(transport.messages), 1)
+        email_from, email_to, message = transport.messages[0]
+        self.assertEqual(email_from, self.mailer.email_from)
+        self.assertEqual(email_to, ['someone@example.com'])
+        self.assertIn('BEGIN:VCALENDAR', message)
+
+        del self.mailer.transport
+        self.assertIs(self.mailer.transport, None)
+
+    def test_observer(self):
+        def _callable():
+            self.mailer.observer = 'not callable'
+        self.assertRaises(TypeError, _callable)
+
+        seen = []
+        self.mailer.observer = lambda *args: seen.append(args)
+        self.mailer.transport = MemoryTransport()
+        self.mailer.attach(self.ical)
+        self.mailer.send_email()
+        stages = dict((stage, nbytes) for stage, _, nbytes, _ in seen)
+        self.assertEqual(sorted(stages), ['ics_render', 'mime_build'])
+        self.assertEqual(stages['ics_render'], len(self.ical.to_string()))
+        message = self.mailer.transport.messages[0][2]
+        self.assertEqual(stages['mime_build'], len(message))
+
+    def test_send_many(self):
+        transport = MemoryTransport()
+        self.mailer.transport = transport
+        events = [iCalendar(event_config(i)) for i in range(3)]
+        self.assertEqual(self.mailer.send_many(iter(events)), 3)
+        self.assertEqual([to for _, to, _ in transport.messages],
+                         [['0@example.com'], ['1@example.com'],
+                          ['2@example.com']])
+        self.assertIn('UID:uid2@', transport.messages[2][2])
+
+        del self.mailer.email_body
+        self.assertRaises(ConfigurationError, self.mailer.send_many, events)
+
+    def test_render_and_deliver(self):
+        rendered = self.mailer.render(self.ical)
+        self.assertEqual(rendered.key, (self.ical.uid, u'', 0))
+        self.assertEqual(rendered.email_to, [u'email@email.com'])
+        self.assertIn('BEGIN:VCALENDAR', rendered.message)
+
+        transport = MemoryTransport()
+        self.mailer.transport = transport
+        self.assertEqual(self.mailer.deliver([rendered, rendered]), 2)
+        self.assertEqual(transport.messages[1],
+                         (rendered.email_from, rendered.email_to,
+                          rendered.message))
+
+    def test_ledger_skips_duplicates(self):
+        def _callable():
+            self.mailer.ledger = {}
+        self.assertRaises(TypeError, _callable)
+
+        ledger = SendLedger(':memory:')
+        transport = MemoryTransport()
+        self.mailer.ledger = ledger
+        self.mailer.transport = transport
+        self.mailer.attach(self.ical)
+        self.mailer.send_email()
+        self.mailer.send_email()
+        self.assertEqual(len(transport.messages), 1)
+        self.assertTrue(ledger.seen(self.ical.uid, u'', 'someone@example.com',
+                                    0))
+
+        rendered = self.mailer.render(self.ical)
+        self.assertEqual(self.mailer.deliver([rendered, rendered]), 1)
+        self.assertEqual(self.mailer.deliver([rendered]), 0)
+        self.assertEqual(len(transport.messages), 2)
+
+        self.ical.location = u'Moved'
+        self.assertEqual(self.mailer.deliver([self.mailer.render(self.ical)]),
+                         1)
+        self.assertEqual(len(ledger), 3)
+
+    def test_ledger_does_not_record_refused(self):
+        ledger = SendLedger(':memory:')
+        transport = MemoryTransport()
+        transport.send = lambda *args: {'b@example.com': (550, 'No')}
+        self.mailer.ledger = ledger
+        self.mailer.transport = transport
+        rendered = self.mailer.render(self.ical)._replace(
+            email_to=['a@example.com', 'b@example.com'])
+        self.mailer.deliver([rendered])
+        self.assertTrue(ledger.seen(self.ical.uid, u'', 'a@example.com', 0))
+        self.assertFalse(ledger.seen(self.ical.uid, u'', 'b@example.com', 0))
+
+    def test_deliver_on_error(self):
+        transport = MemoryTransport()
+        self.mailer.transport = transport
+        rendered = self.mailer.render(self.ical)
+        bad = rendered._replace(email_to=['bad@example.com'])
+        send = transport.send
+
+        def _send(email_from, email_to, message):
+            if email_to == ['bad@example.com']:
+                raise IOError('refused')
+            return send(email_from, email_to, message)
+        transport.send = _send
+
+        self.assertRaises(IOError, self.mailer.deliver, [bad])
+        errors = []
+        sent = self.mailer.deliver([rendered, bad, rendered],
+                                   on_error=lambda *args: errors.append(args))
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(errors), 1)
+        self.assertIs(errors[0][0], bad)
+
+    def test_deliver_on_sent(self):
+        transport = MemoryTransport()
+        self.mailer.transport = transport
+        rendered = self.mailer.render(self.ical)
+        transport.send = Mock(side_effect=[{}, IOError('connection lost')])
+        sent = []
+        self.assertRaises(IOError, self.mailer.deliver, [rendered, rendered],
+                          on_sent=sent.append)
+        self.assertEqual(sent, [rendered])
+
+
+class TestLedger(unittest.TestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        digests = [SendLedger.key(u'uid%d' % i, u'', u'a@b.c', 0)
+                   for i in range(2000)]
+        for digest in digests[:1000]:
+            bloom.add(digest)
+        for digest in digests[:1000]:
+            self.assertIn(digest, bloom)
+        false_positives = sum(1 for d in digests[1000:] if d in bloom)
+        self.assertTrue(false_positives < 50)
+        self.assertRaises(ValueError, BloomFilter, 0)
+        self.assertRaises(ValueError, BloomFilter, 10, 1.5)
+
+    def test_persistence(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'ledger.db')
+        try:
+            ledger = SendLedger(path)
+            self.assertFalse(ledger.seen(u'uid', u'example.com',
+                                         u'a@example.com', 0))
+            ledger.record(u'uid', u'example.com', u'a@example.com', 0)
+            ledger.record(u'uid', u'example.com', u'a@example.com', 0)
+            ledger.close()
+
+            ledger = SendLedger(path)
+            self.assertEqual(len(ledger), 1)
+            self.assertTrue(ledger.seen(u'uid', u'example.com',
+                                        u'<A@Example.com>', 0))
+            self.assertFalse(ledger.seen(u'uid', u'example.com',
+                                         u'a@example.com', 1))
+            self.assertFalse(ledger.seen(u'uid', u'example.org',
+                                         u'a@example.com', 0))
+            ledger.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'invites.archive')
+        self.mailer = Mailer({
+            'email_from': 'organizer@example.com',
+            'email_subject': 'Invitation',
+            'email_body': u'You are invited \u2014 see the agenda',
+        })
+        self.mailer.transport = MemoryTransport()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _events(self, count, tzinfo=None):
+        dtstart = DTSTART.replace(tzinfo=tzinfo)
+        return [iCalendar(event_config(
+            i,
+            dtstart=dtstart + datetime.timedelta(days=i % 3),
+            dtend=dtstart + datetime.timedelta(days=i % 3, hours=1),
+            dtstamp=datetime.datetime(2014, 11, 1),
+            summary='Meeting',
+            location='Room 101',
+            description='Quarterly planning ' * 20,
+        )) for i in range(count)]
+
+    def test_reproduces_messages(self):
+        self.assertRaises(TypeError, setattr, self.mailer, 'archive', None)
+        with ArchiveWriter(self.path, segment_size=4) as archive:
+            self.mailer.archive = archive
+            self.mailer.send_many(self._events(10))
+        sent = [m for _, _, m in self.mailer.transport.messages]
+        self.assertLess(os.path.getsize(self.path),
+                        sum(len(m) for m in sent) / 4)
+
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), 10)
+            for record, message in enumerate(sent):
+                self.assertEqual(reader.message(record), message)
+            self.assertEqual(reader[3][u'attendee_email'], u'3@example.com')
+            self.assertRaises(IndexError, reader.__getitem__, 10)
+
+            self.assertEqual(reader.find(u'uid7'), [7])
+            self.assertEqual(reader.find(u'missing'), [])
+            self.assertEqual(reader.between(datetime.date(2014, 12, 2)),
+                             [1, 4, 7])
+            self.assertEqual(reader.between(datetime.date(2014, 12, 2),
+                                            datetime.date(2014, 12, 9)),
+                             [1, 4, 7, 2, 5, 8])
+
+    def test_timezone_and_revisions(self):
+        events = self._events(2, tzinfo=Berlin())
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            self.mailer.send_many(events)
+            events[0].to_string()
+            events[0].location = u'Room 2'
+            self.mailer.send_many(events[:1])
+        sent = [m for _, _, m in self.mailer.transport.messages]
+        self.assertIn('TZID=Europe/Berlin', sent[0])
+
+        # A second writer appends to the same file
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            self.mailer.send_many(events[1:])
+        sent.append(self.mailer.transport.messages[-1][2])
+
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual([reader.message(r) for r in range(len(reader))],
+                             sent)
+            self.assertEqual(reader.find(u'uid0'), [0, 2])
+            self.assertEqual(reader[2][u'sequence'], u'1')
+            self.assertEqual(reader.icalendar(2).to_string(),
+                             events[0].to_string())
+
+    def test_records_sent_messages_only(self):
+        event = self._events(1)[0]
+        transport = self.mailer.transport
+        self.mailer.ledger = SendLedger(':memory:')
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            self.assertEqual(self.mailer.send_many([event]), 1)
+            self.assertEqual(self.mailer.send_many([event]), 0)
+
+            event.sequence = 1
+            transport.send = Mock(side_effect=IOError('refused'))
+            errors = []
+            self.mailer.deliver([self.mailer.render(event)],
+                                on_error=lambda *args: errors.append(args))
+            self.assertEqual(len(errors), 1)
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), 1)
+            self.assertEqual(reader[0][u'sequence'], u'0')
+
+    def test_delivered_to(self):
+        self.mailer.set_config({'email_to': [
+            u'"Doe, Jane" <jane@example.com>', u'joe@example.com']})
+        self.mailer.attach(self._events(1)[0])
+        transport = self.mailer.transport
+        transport.send = Mock(return_value={
+            u'joe@example.com': (550, 'No such user')})
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            self.mailer.send_email()
+        message = transport.send.call_args[0][2]
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(reader[0][u'delivered_to'],
+                             u'"Doe, Jane" <jane@example.com>')
+            self.assertEqual(reader.message(0), message)
+
+    def test_archives_at_send_time(self):
+        events = self._events(2)
+        self.assertIs(self.mailer.render(events[0]).source, None)
+        rendered = [self.mailer.render(event, keep_source=True)
+                    for event in events]
+        events[0].location = u'Room 2'
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            self.mailer.deliver(rendered)
+            # deliver writes out what it archived
+            with ArchiveReader(self.path) as reader:
+                self.assertEqual(len(reader), 2)
+                self.assertEqual(reader.message(0), rendered[0].message)
+                self.assertEqual(reader[0][u'location'], u'Room 101')
+
+    def test_render_pool(self):
+        config = {
+            'email_from': self.mailer.email_from,
+            'email_subject': self.mailer.email_subject,
+            'email_body': self.mailer.email_body,
+        }
+        records = [event_config(i, summary='Meeting') for i in range(5)]
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            # Without their source, the messages cannot be archived, so
+            # they are not sent
+            self.assertRaises(ValueError, self.mailer.deliver,
+                              render_pool(records, config, processes=1))
+            self.assertEqual(self.mailer.transport.messages, [])
+            self.mailer.deliver(render_pool(records, config, processes=2,
+                                            chunksize=2, archive=True))
+        sent = [m for _, _, m in self.mailer.transport.messages]
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual([wire_format(reader.message(r))
+                              for r in range(len(reader))], sent)
+
+    def test_flush_interval(self):
+        with ArchiveWriter(self.path, flush_interval=0) as archive:
+            rendered = self.mailer.render(self._events(1)[0], True)
+            archive.add(rendered.source, rendered.message,
+                        rendered.email_from, rendered.email_to)
+            with ArchiveReader(self.path) as reader:
+                self.assertEqual(len(reader), 1)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not an archive')
+        self.assertRaises(ValueError, ArchiveReader, self.path)
+        self.assertRaises(ValueError, ArchiveWriter, self.path)
+
+    def _append(self, events):
+        with ArchiveWriter(self.path) as archive:
+            self.mailer.archive = archive
+            self.mailer.send_many(events)
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_index(self):
+        with ArchiveWriter(self.path, segment_size=4) as archive:
+            self.mailer.archive = archive
+            self.mailer.send_many(self._events(10))
+            self.mailer.send_many(self._events(1))
+
+        import fortnight.archive
+        decompress = Mock(side_effect=zlib.decompress)
+        with patch.object(fortnight.archive.zlib, 'decompress', decompress):
+            with ArchiveReader(self.path) as reader:
+                # Opening reads the segment headers only
+                self.assertEqual(len(reader), 11)
+                self.assertEqual(decompress.call_count, 0)
+
+                # Lookups read the index blocks, not the string tables
+                self.assertEqual(reader.find(u'uid0'), [0, 10])
+                self.assertEqual(decompress.call_count, 2 * 4)
+                self.assertEqual(reader.find(u'uid5'), [5])
+                self.assertEqual(decompress.call_count, 2 * 4)
+                self.assertEqual(reader.between(datetime.date(2014, 12, 3)),
+                                 [2, 5, 8])
+                self.assertEqual(decompress.call_count, 2 * 4 + 3)
+                # No segment holds dates this late
+                self.assertEqual(reader.between(datetime.date(2015, 1, 1)),
+                                 [])
+                self.assertEqual(decompress.call_count, 2 * 4 + 3)
+
+    def test_torn_segment(self):
+        events = self._events(9)
+        first = self._append(events[:3])
+        second = self._append(events[3:6])[len(first):]
+
+        # A crash while the second segment was written
+        with open(self.path, 'wb') as f:
+            f.write(first + second[:len(second) // 2])
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+            self.assertEqual(reader.damaged, [(len(first), len(first) +
+                                               len(second) // 2)])
+            self.assertEqual(reader[2][u'uid'], u'uid2')
+
+        # The next writer cuts the torn segment off before appending
+        self._append(events[6:])
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(reader.damaged, [])
+            self.assertEqual([reader[r][u'uid'] for r in range(len(reader))],
+                             [u'uid0', u'uid1', u'uid2', u'uid6', u'uid7',
+                              u'uid8'])
+
+        # Torn bytes followed by intact segments are skipped
+        with open(self.path, 'wb') as f:
+            f.write(first + second[:20] + second + second[:-1])
+        with ArchiveReader(self.path) as reader:
+            self.assertEqual(len(reader), 6)
+            self.assertEqual(reader.find(u'uid4'), [4])
+            self.assertEqual(len(reader.damaged), 2)
+            self.assertEqual(reader.damaged[0],
+                             (len(first), len(first) + 20))
+
+
+class TestRender(unittest.TestCase):
+    def test_render_pool(self):
+        records = (event_config(i) for i in range(25))
+        config = {
+            'email_from': 'organizer@example.com',
+            'email_subject': 'Invitation',
+            'email_body': 'You are invited',
+        }
+        rendered = list(render_pool(records, config, processes=2,
+                                    chunksize=4))
+        self.assertEqual([r.key[0] for r in rendered],
+                         ['uid%d' % i for i in range(25)])
+        self.assertEqual(rendered[3].email_to, [u'3@example.com'])
+        self.assertIsInstance(rendered[3].message, bytes)
+        self.assertIn(b'\r\nUID:uid3@', rendered[3].message)
+        self.assertNotIn(b'\n\n', rendered[3].message)
+
+        def _callable():
+            list(render_pool([{'bogus': 1}], config, processes=1))
+        self.assertRaises(ValueError, _callable)
+
+    def test_render_pool_bounded(self):
+        pulled = []
+
+        def records():
+            for i in range(1000):
+                pulled.append(i)
+                yield event_config(i)
+        config = {
+            'email_from': 'organizer@example.com',
+            'email_subject': 'Invitation',
+            'email_body': 'You are invited',
+        }
+        rendered = render_pool(records(), config, processes=1, chunksize=5,
+                               window=2)
+        self.assertEqual(next(rendered).key[0], 'uid0')
+        # Only the chunks in the window were read ahead
+        self.assertEqual(len(pulled), 10)
+        for _ in range(5):
+            next(rendered)
+        self.assertEqual(len(pulled), 15)
+        rendered.close()
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.store = {}
+        for i in range(5):
+            ical = iCalendar(event_config(i))
+            ical.to_string()
+            self.store[ical.uid] = ical
+
+    def test_cancel_by_uid(self):
+        cancelled = list(batch.cancel(['uid1', 'uid3'], store=self.store))
+        self.assertEqual([e.uid for e in cancelled], ['uid1', 'uid3'])
+        for event in cancelled:
+            ical_str = event.to_string()
+            self.assertIn(u'METHOD:CANCEL\n', ical_str)
+            self.assertIn(u'STATUS:CANCELLED\n', ical_str)
+            self.assertIn(u'SEQUENCE:1\n', ical_str)
+        self.assertEqual(self.store['uid0'].method, u'REQUEST')
+
+    def test_cancel_stored_event(self):
+        # Loaded from storage and never serialized in this process
+        stored = iCalendar(event_config(7, sequence=2))
+        cancelled = next(batch.cancel([stored]))
+        ical_str = cancelled.to_string()
+        self.assertIn(u'METHOD:CANCEL\n', ical_str)
+        self.assertIn(u'SEQUENCE:3\n', ical_str)
+
+    def test_cancel_events_is_lazy(self):
+        events = batch.cancel(self.store.values())
+        self.assertEqual(self.store['uid0'].method, u'REQUEST')
+        self.assertEqual(len(list(events)), 5)
+        self.assertEqual(self.store['uid0'].method, u'CANCEL')
+
+    def test_cancel_unknown_uid(self):
+        self.assertRaises(KeyError, list,
+                          batch.cancel(['missing'], store=self.store))
+        self.assertRaises(TypeError, list, batch.cancel(['uid1']))
+
+    def test_update(self):
+        later = datetime.datetime(2014, 12, 2, 9)
+        updated = list(batch.update(['uid2'], store=self.store,
+                                    dtstart=later, location='Room 2'))
+        event = updated[0]
+        self.assertEqual(event.dtstart, later)
+        ical_str = event.to_string()
+        self.assertIn(u'METHOD:REQUEST\n', ical_str)
+        self.assertIn(u'LOCATION:Room 2\n', ical_str)
+        self.assertIn(u'SEQUENCE:1\n', ical_str)
+
+        self.assertRaises(ValueError, list,
+                          batch.update(['uid3'], store=self.store,
+                                       location='Room 3', bogus=1))
+        self.assertRaises(TypeError, list,
+                          batch.update(['uid3'], store=self.store,
+                                       location='Room 3', dtstart='tomorrow'))
+        self.assertRaises(ValueError, list,
+                          batch.derive(['uid3'], u'CANCELX', store=self.store,
+                                       location='Room 3'))
+        self.assertEqual(self.store['uid3'].location, u'')
+        self.assertEqual(self.store['uid3'].method, u'REQUEST')
+        self.assertEqual(self.store['uid3'].sequence, 0)
+
+    def test_stream_into_mailer(self):
+        mailer = Mailer({
+            'email_from': 'organizer@example.com',
+            'email_subject': 'Cancelled',
+            'email_body': 'The office is closed',
+        })
+        mailer.transport = MemoryTransport()
+        sent = mailer.send_many(batch.cancel(sorted(self.store),
+                                             store=self.store))
+        self.assertEqual(sent, 5)
+        for _, _, message in mailer.transport.messages:
+            self.assertIn('method="CANCEL"', message)
+
+
+REPLY = u"""BEGIN:VCALENDAR
+VERSION:2.0
+METHOD:REPLY
+BEGIN:VEVENT
+UID:%(uid)s@example.com
+SEQUENCE:%(sequence)d
+DTSTAMP:%(dtstamp)s
+ATTENDEE;CN="Doe; Jane";PARTSTAT=%(partstat)s:MAILTO:%(attendee)s
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+class TestReplies(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.events = [iCalendar(event_config(
+            i, uid_fqdn='example.com',
+            attendee_email='Attendee%d@example.com' % i)) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _reply(self, i, partstat, sequence=0, dtstamp='20141201T080000Z'):
+        return REPLY % {'uid': 'uid%d' % i, 'attendee': 'attendee%d@'
+                        'example.com' % i, 'partstat': partstat,
+                        'sequence': sequence, 'dtstamp': dtstamp}
+
+    def _message(self, ics):
+        message = mailbox.mboxMessage()
+        message['From'] = 'attendee@example.com'
+        message['Subject'] = 'Accepted'
+        message.set_payload(ics.encode('utf-8'))
+        message.set_type('text/calendar')
+        message.set_param('method', 'REPLY')
+        return message
+
+    def test_parse_replies(self):
+        ics = self._reply(1, 'ACCEPTED').replace(
+            u'MAILTO:', u'\n MAILTO:')
+        parsed = list(replies.parse_replies(ics))
+        self.assertEqual(parsed, [replies.Reply(
+            u'uid1@example.com', u'attendee1@example.com', u'ACCEPTED', 0,
+            u'20141201T080000Z')])
+
+        counter = self._reply(1, 'ACCEPTED').replace(u'REPLY', u'COUNTER')
+        self.assertEqual(list(replies.parse_replies(counter)), [])
+
+    def test_apply_replies(self):
+        index = replies.index_events(self.events)
+        self.events[2].sequence = 1
+        result = replies.apply_replies([
+            replies.Reply(u'uid0@example.com', u'attendee0@example.com',
+                          u'ACCEPTED', 0, u'20141201T080000Z'),
+            replies.Reply(u'uid0@example.com', u'attendee0@example.com',
+                          u'TENTATIVE', 0, u'20141201T070000Z'),
+            replies.Reply(u'uid1@example.com', u'someone@example.com',
+                          u'DECLINED', 0, u'20141201T080000Z'),
+            replies.Reply(u'uid2@example.com', u'attendee2@example.com',
+                          u'DECLINED', 0, u'20141201T080000Z'),
+            replies.Reply(u'missing@example.com', u'attendee0@example.com',
+                          u'DECLINED', 0, u'20141201T080000Z'),
+        ], index)
+        self.assertEqual(result, (1, 2, 2))
+        self.assertEqual([e.partstat for e in self.events],
+                         [u'ACCEPTED', u'NEEDS-ACTION', u'NEEDS-ACTION'])
+
+    def test_ingest_mbox(self):
+        path = os.path.join(self.tmpdir, 'rsvp.mbox')
+        box = mailbox.mbox(path)
+        box.add(self._message(self._reply(0, 'ACCEPTED')))
+        box.add(self._message(self._reply(1, 'DECLINED')))
+        box.close()
+
+        result = replies.ingest(path, self.events)
+        self.assertEqual(result, (2, 0, 0))
+        self.assertEqual([e.partstat for e in self.events],
+                         [u'ACCEPTED', u'DECLINED', u'NEEDS-ACTION'])
+        self.assertIn(u'PARTSTAT=DECLINED;', self.events[1].to_string())
+
+    def test_ingest_maildir(self):
+        path = os.path.join(self.tmpdir, 'rsvp')
+        mailer = Mailer({
+            'email_from': 'attendee2@example.com',
+            'email_subject': 'Tentative',
+            'email_body': 'Maybe',
+        })
+        mailer.transport = MaildirTransport(path)
+        reply = self.events[2]
+        reply.method = u'REPLY'
+        reply.partstat = u'TENTATIVE'
+        mailer.send_many([reply])
+        reply.method = u'REQUEST'
+        del reply.partstat
+
+        result = replies.ingest(path, self.events)
+        self.assertEqual(result, (1, 0, 0))
+        self.assertEqual(self.events[2].partstat, u'TENTATIVE')
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.maildir = os.path.join(self.tmpdir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def _main(self, *argv):
+        argv = ['--from', 'organizer@example.com', '--subject', 'Invite',
+                '--body', 'You are invited', '--maildir', self.maildir,
+                '--workers', '2'] + list(argv)
+        with patch('sys.stderr') as stderr:
+            result = cli.main(argv)
+        return result, ''.join(c[0][0] for c in stderr.write.call_args_list)
+
+    def _messages(self):
+        return [str(m) for m in mailbox.Maildir(self.maildir, factory=None)]
+
+    def test_password(self):
+        argv = ['--from', 'organizer@example.com', '--subject', 'Invite',
+                '--body', 'You are invited', '--username', 'organizer']
+        with patch.dict(os.environ, {cli.PASSWORD_ENV: 'secret'}):
+            self.assertEqual(cli.parse_args(argv).password, 'secret')
+            path = self._write('password', 'from file\n')
+            args = cli.parse_args(argv + ['--password-file', path])
+            self.assertEqual(args.password, 'from file')
+        with patch.dict(os.environ, {cli.PASSWORD_ENV: ''}), \
+                patch('sys.stderr'):
+            self.assertRaises(SystemExit, cli.parse_args, argv)
+            self.assertRaises(SystemExit, cli.parse_args,
+                              argv + ['--password', 'secret'])
+
+    def test_parse_datetime(self):
+        expected = datetime.datetime(2014, 12, 1, 7, 30)
+        for value in ('20141201T073000Z', '2014-12-01T07:30:00',
+                      '2014-12-01 07:30', '2014-12-01T07:30Z'):
+            self.assertEqual(cli.parse_datetime(value), expected)
+        self.assertRaises(ValueError, cli.parse_datetime, 'tomorrow')
+
+    def test_csv(self):
+        path = self._write('events.csv', (
+            'uid,attendee_email,organizer_email,dtstart,dtend,summary\n'
+            'a,a@example.com,o@example.com,2014-12-01T07:30,'
+            '2014-12-01T08:30,First\n'
+            'b,b@example.com,o@example.com,2014-12-02T07:30,'
+            '2014-12-02T08:30,Second\n'
+            'c,c@example.com,o@example.com,not a date,'
+            '2014-12-02T08:30,Broken\n'))
+        archive = os.path.join(self.tmpdir, 'invites.archive')
+        result, log = self._main(path, '--archive', archive)
+        self.assertEqual(result, 1)
+        self.assertIn('row 3:', log)
+        self.assertIn('sent=2 skipped=0 failed=1', log)
+        messages = self._messages()
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(any('UID:b@' in m for m in messages))
+        self.assertTrue(any('X-Original-To: b@example.com\n' in m
+                            for m in messages))
+        with ArchiveReader(archive) as reader:
+            self.assertEqual(len(reader), 2)
+
+    def test_jsonl_with_ledger(self):
+        rows = [json.dumps({
+            'uid': 'event%d' % i,
+            'attendee_email': '%d@example.com' % i,
+            'organizer_email': 'o@example.com',
+            'dtstart': '20141201T073000Z',
+            'dtend': '20141201T083000Z',
+            'summary': 'Meeting',
+        }) for i in range(5)]
+        path = self._write('events.jsonl', '\n'.join(rows) + '\n\n')
+        ledger = os.path.join(self.tmpdir, 'ledger.db')
+        result, log = self._main(path, '--ledger', ledger)
+        self.assertEqual(result, 0)
+        self.assertIn('sent=5 skipped=0 failed=0', log)
+        result, log = self._main(path, '--ledger', ledger)
+        self.assertIn('sent=0 skipped=5 failed=0', log)
+        self.assertEqual(len(self._messages()), 5)
+
+    def test_rerun_without_uids(self):
+        path = self._write('events.csv', (
+            'attendee_email,organizer_email,dtstart,dtend,summary\n'
+            'a@example.com,o@example.com,2014-12-01T07:30,'
+            '2014-12-01T08:30,First\n'
+            'b@example.com,o@example.com,2014-12-02T07:30,'
+            '2014-12-02T08:30,Second\n'))
+        ledger = os.path.join(self.tmpdir, 'ledger.db')
+        result, log = self._main(path, '--ledger', ledger)
+        self.assertIn('sent=2 skipped=0 failed=0', log)
+        result, log = self._main(path, '--ledger', ledger)
+        self.assertEqual(result, 0)
+        self.assertIn('sent=0 skipped=2 failed=0', log)
+        self.assertEqual(len(self._messages()), 2)
+
+    def test_row_uid(self):
+        row = {'attendee_email': 'a@example.com', 'summary': 'First',
+               'dtstart': '2014-12-01T07:30'}
+        uid = cli.row_uid(row)
+        self.assertEqual(cli.row_uid(dict(row, dtstamp='20141130T000000Z',
+                                          sequence='2', location='')), uid)
+        self.assertNotEqual(cli.row_uid(dict(row, summary='Second')), uid)
+
+    def test_malformed_jsonl(self):
+        good = json.dumps({
+            'attendee_email': 'a@example.com',
+            'organizer_email': 'o@example.com',
+            'dtstart': '20141201T073000Z',
+            'dtend': '20141201T083000Z',
+            'summary': 'Meeting',
+        })
+        path = self._write('events.jsonl', good + '\n{"uid": \n[1, 2]\n')
+        archive = os.path.join(self.tmpdir, 'invites.archive')
+        result, log = self._main(path, '--archive', archive)
+        self.assertEqual(result, 1)
+        self.assertIn('row 2:', log)
+        self.assertIn('row 3: row is not an object', log)
+        self.assertIn('sent=1 skipped=0 failed=2', log)
+        self.assertEqual(len(self._messages()), 1)
+        with ArchiveReader(archive) as reader:
+            self.assertEqual(len(reader), 1)
+
+    def test_sender_fails_to_connect(self):
+        rows = ['{"attendee_email": "%d@example.com", '
+                '"organizer_email": "o@example.com", '
+                '"dtstart": "20141201T073000Z", "dtend": "20141201T083000Z", '
+                '"summary": "Meeting"}' % i for i in range(500)]
+        path = self._write('events.jsonl', '\n'.join(rows) + '\n')
+        opened = []
+        open_maildir = MaildirTransport.open
+
+        def _open(transport):
+            # One sender is refused a connection; the others carry on
+            opened.append(transport)
+            if opened[0] is transport:
+                raise IOError('too many connections')
+            return open_maildir(transport)
+
+        with patch.object(MaildirTransport, 'open', _open):
+            result, log = self._main(path, '--workers', '4')
+        self.assertEqual(result, 0)
+        self.assertEqual(log.count('sender stopped'), 1)
+        self.assertIn('sent=500 skipped=0 failed=0', log)
+        self.assertEqual(len(self._messages()), 500)
+
+    def test_sender_stopped(self):
+        path = self._write('events.csv', (
+            'attendee_email,organizer_email,dtstart,dtend,summary\n'
+            'a@example.com,o@example.com,2014-12-01T07:30,2014-12-01T08:30,A\n'
+            'b@example.com,o@example.com,2014-12-01T07:30,2014-12-01T08:30,B\n'
+        ))
+        send = MaildirTransport.send
+        calls = []
+
+        def _send(transport, *args):
+            # The first message goes through, then the transport fails
+            # outside of the per-message error handling
+            calls.append(args)
+            if len(calls) > 1:
+                raise IOError('disk full')
+            return send(transport, *args)
+
+        with patch.object(MaildirTransport, 'send', _send), \
+                patch.object(MaildirTransport, 'reset',
+                             Mock(side_effect=IOError('disk full'))):
+            result, log = self._main(path, '--workers', '1')
+        self.assertEqual(result, 1)
+        self.assertIn('sender stopped', log)
+        self.assertIn('sent=1 skipped=0 failed=1', log)
+
+
+class TestInstrument(unittest.TestCase):
+    def test_timer_disabled(self):
+        self.assertIs(timer(None, 'a'), timer(None, 'b'))
+        with timer(None, 'stage') as t:
+            t.nbytes = 10
+
+    def test_timer(self):
+        seen = []
+        with timer(lambda *args: seen.append(args), 'stage', 5):
+            pass
+        self.assertEqual(len(seen), 1)
+        stage, seconds, nbytes, error = seen[0]
+        self.assertEqual((stage, nbytes, error), ('stage', 5, None))
+        self.assertTrue(seconds >= 0)
+
+        def _callable():
+            with timer(lambda *args: seen.append(args), 'failing'):
+                raise ValueError()
+        self.assertRaises(ValueError, _callable)
+        self.assertEqual(seen[1][0], 'failing')
+        self.assertEqual(seen[1][3], 'ValueError')
+
+    def test_histogram_observer(self):
+        observer = HistogramObserver(buckets=(0.1, 1.0))
+        observer('data', 0.05, 100)
+        observer('data', 0.5, 50)
+        observer('data', 5.0, 0)
+        observer('connect', 10.0, 0, 'timeout')
+        self.assertEqual(observer.count('data'), 3)
+        self.assertEqual(observer.count('quit'), 0)
+        self.assertEqual(observer.count('connect'), 0)
+        self.assertEqual(observer.count('connect', 'error'), 1)
+        text = observer.exposition()
+        self.assertIn('fortnight_stage_duration_seconds_bucket'
+                      '{stage="data",outcome="ok",le="0.1"} 1', text)
+        self.assertIn('fortnight_stage_duration_seconds_bucket'
+                      '{stage="data",outcome="ok",le="1.0"} 2', text)
+        self.assertIn('fortnight_stage_duration_seconds_bucket'
+                      '{stage="data",outcome="ok",le="+Inf"} 3', text)
+        self.assertIn('fortnight_stage_duration_seconds_count'
+                      '{stage="connect",outcome="error"} 1', text)
+        self.assertIn('fortnight_stage_bytes_total'
+                      '{stage="data",outcome="ok"} 150', text)
+
+
+class TestTransport(unittest.TestCase):
+    @patch('smtplib.SMTP')
+    def test_smtp_single_message(self, PatchedSmtplib):
+        transport = SMTPTransport('localhost', 25)
+        transport.send('from@example.com', ['to@example.com'], 'message')
+        smtp = PatchedSmtplib.return_value
+        smtp.connect.assert_called_once_with('localhost', 25)
+        smtp.sendmail.assert_called_once_with(
+            'from@example.com', ['to@example.com'], 'message')
+        smtp.quit.assert_called_once_with()
+        self.assertFalse(transport.connected)
+
+    def test_smtp_observer(self):
+        seen = []
+        recipients = ['a@example.com', 'b@example.com']
+        plain = StubSMTP(refuse=['b@example.com'])
+        timed = StubSMTP(refuse=['b@example.com'])
+        StubTransport(plain).send('from@example.com', recipients, 'message')
+        refused = StubTransport(
+            timed, observer=lambda *args: seen.append(args)).send(
+                'from@example.com', recipients, 'message')
+
+        # Timing does not change the SMTP conversation
+        self.assertEqual(timed.sent, plain.sent)
+        self.assertEqual(list(refused), ['b@example.com'])
+        self.assertEqual([(stage, error) for stage, _, _, error in seen],
+                         [('connect', None), ('ehlo', None), ('mail', None),
+                          ('rcpt', None), ('rcpt', 'SMTP550'),
+                          ('data', None), ('quit', None)])
+        self.assertEqual(seen[5][2], len('message'))
+
+    def test_smtp_observer_data_error(self):
+        seen = []
+        transport = StubTransport(StubSMTP(data_reply=(421, b'closing')),
+                                  observer=lambda *args: seen.append(args))
+        transport.open()
+        self.assertRaises(smtplib.SMTPDataError, transport.send,
+                          'from@example.com', ['a@example.com'], 'message')
+        self.assertEqual(seen[-1][0], 'data')
+        self.assertEqual(seen[-1][3], 'SMTP421')
+
+    def test_smtp_quit_failure_after_data(self):
+        def quit():
+            raise socket.timeout('timed out')
+        client = StubSMTP()
+        client.quit = quit
+        ledger = SendLedger(':memory:')
+        mailer = Mailer({
+            'email_from': 'organizer@example.com',
+            'email_subject': 'Invitation',
+            'email_body': 'You are invited',
+        })
+        mailer.transport = StubTransport(client)
+        mailer.ledger = ledger
+        mailer.attach(iCalendar(event_config(1)))
+        mailer.email_to = '1@example.com'
+        mailer.send_email()
+        # Accepted by the relay, so recorded despite the QUIT timeout
+        self.assertTrue(ledger.seen('uid1', '', '1@example.com', 0))
+        self.assertTrue(client.sent[-1].endswith('\r\n.\r\n'))
+
+    @patch('smtplib.SMTP')
+    def test_smtp_reuses_connection(self, PatchedSmtplib):
+        with SMTPTransport('localhost') as transport:
+            self.assertTrue(transport.connected)
+            for i in range(3):
+                transport.send('from@example.com', ['to@example.com'], 'm')
+        self.assertEqual(PatchedSmtplib.call_count, 1)
+        smtp = PatchedSmtplib.return_value
+        self.assertEqual(smtp.sendmail.call_count, 3)
+        smtp.quit.assert_called_once_with()
+
+    @patch('smtplib.SMTP')
+    def test_smtp_reset(self, PatchedSmtplib):
+        transport = SMTPTransport('localhost')
+        transport.reset()
+        self.assertFalse(transport.connected)
+
+        transport.open()
+        smtp = PatchedSmtplib.return_value
+        smtp.quit.side_effect = smtplib.SMTPServerDisconnected()
+        transport.reset()
+        smtp.close.assert_called_once_with()
+        self.assertTrue(transport.connected)
+        self.assertEqual(smtp.connect.call_count, 2)
+
+    @patch('smtplib.LMTP')
+    def test_lmtp(self, PatchedLmtp):
+        lmtp = PatchedLmtp.return_value
+        lmtp.mail.return_value = lmtp.rcpt.return_value = (250, b'OK')
+        lmtp.data.return_value = (250, b'delivered')
+        transport = LMTPTransport('/var/run/lmtp.sock')
+        transport.send('from@example.com', ['to@example.com'], 'message')
+        self.assertEqual(lmtp.connect.call_args[0][0], '/var/run/lmtp.sock')
+        lmtp.data.assert_called_once_with('message')
+
+    def test_maildir_created_concurrently(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'spool')
+        try:
+            # Another sender is half way through creating the maildir
+            os.mkdir(path)
+            os.mkdir(os.path.join(path, 'tmp'))
+            transport = MaildirTransport(path)
+            transport.send('from@example.com', ['to@example.com'], 'm\n')
+            self.assertEqual(len(mailbox.Maildir(path, factory=None)), 1)
+            MaildirTransport(path).open()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_wire_format(self):
+        mailer = Mailer({
+            'email_from': 'organizer@example.com',
+            'email_subject': 'Invitation',
+            'email_body': 'You are invited',
+        })
+        message = mailer.render(iCalendar(event_config(1))).message
+        wire = wire_format(message)
+        self.assertEqual(wire_format(wire), wire)
+
+        # The same data is sent as for the text
+        text, data = StubSMTP(), StubSMTP()
+        StubTransport(text).send('from@example.com', ['a@example.com'],
+                                 message)
+        StubTransport(data).send('from@example.com', ['a@example.com'],
+                                 wire)
+        self.assertEqual(data.sent[-2], text.sent[-2])
+        self.assertTrue(data.sent[-2].endswith('\r\n.\r\n'))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'spool')
+            MaildirTransport(path).send('from@example.com',
+                                        [u'a@example.com'], wire)
+            stored, = mailbox.Maildir(path, factory=None).values()
+            self.assertNotIn('\r', str(stored))
+            self.assertIn('X-Original-To: a@example.com\n', str(stored))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lmtp_reply_per_recipient(self):
+        client = StubSMTP(refuse=['c@example.com'], data_replies=[
+            (250, b'delivered'), (452, b'mailbox full'),
+            (250, b'delivered')])
+        recipients = ['a@example.com', 'b@example.com', 'c@example.com']
+        with StubLMTPTransport(client) as transport:
+            refused = transport.send('from@example.com', recipients, 'm')
+            self.assertEqual(sorted(refused),
+                             ['b@example.com', 'c@example.com'])
+            self.assertEqual(refused['b@example.com'][0], 452)
+            # Every reply to the first message was read, so the next one
+            # gets its own
+            self.assertEqual(
+                transport.send('from@example.com', ['a@example.com'], 'm'),
+                {})
+        self.assertEqual(client.data_replies, [])
+
+        client = StubSMTP(data_replies=[(550, b'no'), (452, b'full')])
+        transport = StubLMTPTransport(client)
+        self.assertRaises(smtplib.SMTPRecipientsRefused, transport.send,
+                          'from@example.com', recipients[:2], 'm')
+
+    def test_maildir(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'spool')
+        try:
+            transport = MaildirTransport(path)
+            refused = transport.send('from@example.com', ['to@example.com'],
+                                     'Subject: test\n\nbody\n')
+            self.assertEqual(refused, {})
+            transport.close()
+            maildir = mailbox.Maildir(path, factory=None, create=False)
+            key, = maildir.keys()
+            self.assertEqual(maildir[key]['Subject'], 'test')
+            self.assertEqual(maildir[key]['Return-Path'],
+                             '<from@example.com>')
+            self.assertEqual(maildir[key].get_all('X-Original-To'),
+                             ['to@example.com'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_memory(self):
+        transport = MemoryTransport()
+        transport.send('from@example.com', ['to@example.com'], 'message')
+        self.assertEqual(transport.messages,
+                         [('from@example.com', ['to@example.com'], 'message')])
+
 
 if __name__ == '__main__':
     unittest.main()